@@ -6,7 +6,7 @@
     "category": "Extra Tools",
     # "live_test_url": "http://apps.it-projects.info/shop/product/DEMO-URL?version=12.0",
     "images": [],
-    "version": "12.0.1.1.0",
+    "version": "12.0.1.4.2",
     "application": False,
 
     "author": "IT-Projects LLC, Ivan Yelizariev",
@@ -23,6 +23,7 @@
         "security/res_groups_data.xml",
         "security/ir_rule_data.xml",
         "security/ir.model.access.csv",
+        "data/ir_cron_data.xml",
     ],
     "demo": [
     ],
@@ -6,6 +6,7 @@ import logging
 
 from odoo import http
 from odoo.http import request
+from ..tools import signed_token
 
 _logger = logging.getLogger(__name__)
 
@@ -15,29 +16,43 @@ class AuthQuickMaster(http.Controller):
     @http.route('/auth_quick_master/get-token', type="http", auth='user')
     def get_token(self, build, build_user_id, build_login, build_url):
         _logger.debug('Request for token: build reference = %s, build_user_id = %s, build_login = %s, build_url = %s', build, build_user_id, build_login, build_url)
-        token_obj = request.env['auth_quick_master.token'].create({
+        vals = {
             'build': build,
             'build_login': build_login,
             'build_user_id': build_user_id,
-        }).sudo()
-
-        if not token_obj.user_has_access():
+        }
+        # check access before saving the token
+        token_draft = request.env['auth_quick_master.token'].new(vals).sudo()
+        if not token_draft.user_has_access():
             return """{"error": "You don't have access"}"""
-
-        build_url = token_obj.get_build_url() or build_url
+        build_url = token_draft.get_build_url() or build_url
 
         if not build_url:
             return """{"error": "Build url is unknown"}"""
 
-        url = urllib.parse.urljoin(build_url, '/auth_quick/check-token?token=%s' % token_obj.token)
+        token = request.env['auth_quick_master.token'].issue_token(vals)
+        url = urllib.parse.urljoin(build_url, '/auth_quick/check-token?token=%s' % token)
         return werkzeug.utils.redirect(url, 302)
 
     @http.route('/auth_quick_master/check-token', type="json", auth='public')
     def check_token(self, token):
+        """Reference of the build is returned, so the build can reject tokens issued for other builds"""
         _logger.debug('Checking for token: %s', token)
+        if signed_token.is_signed(token):
+            try:
+                payload = request.env['auth_quick_master.token'].sudo().check_signed_token(token)
+            except signed_token.InvalidToken as e:
+                _logger.info('Signed token is not accepted: %s', e)
+                return {"error": str(e)}
+            return {"success": "ok", "data": {
+                "build": payload['build'],
+                "build_user_id": payload['build_user_id'],
+                "build_login": payload['build_login'],
+            }}
+
         token_obj = request.env['auth_quick_master.token'].sudo().search([
             ('token', '=', token)
-        ])
+        ], limit=1)
         if token_obj.is_obsolete():
             return {"error": "Token is obsolete"}
 
@@ -45,6 +60,7 @@ class AuthQuickMaster(http.Controller):
             return {"error": "User doesn't have access"}
 
         return {"success": "ok", "data": {
+            "build": token_obj.build,
             "build_user_id": token_obj.build_user_id,
             "build_login": token_obj.build_login,
         }}
@@ -4,13 +4,25 @@
 import uuid
 from dateutil.relativedelta import relativedelta
 import logging
+import threading
+import time
 import urllib.parse
 from ..tools.build_redirection import build_redirection
+from ..tools import signed_token
 
-from odoo import models, fields
+from odoo import models, fields, api, tools
 
 _logger = logging.getLogger(__name__)
 
+# token can be used during this number of minutes after creation
+TOKEN_LIFETIME = 5
+# number of tokens deleted in one transaction by purge_obsolete_tokens
+PURGE_BATCH_SIZE = 10000
+# seconds to remember result of access check
+ACCESS_CACHE_TTL = 60
+# (dbname, user_id) -> (has_access, expiration time)
+_access_cache = {}
+
 
 class Token(models.Model):
     _name = 'auth_quick_master.token'
@@ -22,9 +34,19 @@ class Token(models.Model):
     build_user_id = fields.Integer('User ID')
     token = fields.Char(default=lambda self: str(uuid.uuid4()))
 
+    _sql_constraints = [
+        ('token_uniq', 'unique (token)', 'Token must be unique'),
+    ]
+
+    def _auto_init(self):
+        res = super(Token, self)._auto_init()
+        # used by purge_obsolete_tokens
+        tools.create_index(self._cr, 'auth_quick_master_token_create_date_index', self._table, ['create_date'])
+        return res
+
     def is_obsolete(self):
         self.ensure_one()
-        is_obsolete = self.create_date + relativedelta(minutes=5) < fields.Datetime.now()
+        is_obsolete = self.create_date + relativedelta(minutes=TOKEN_LIFETIME) < fields.Datetime.now()
         if is_obsolete:
             _logger.info('Token is obsolete: %s', self.token)
         return is_obsolete
@@ -32,7 +54,11 @@ class Token(models.Model):
     def user_has_access(self):
         """Can be extended"""
         self.ensure_one()
-        has_access = self.user_id.has_group('auth_quick_master.group_auth_quick')
+        key = (self.env.cr.dbname, self.user_id.id)
+        has_access, expiration = _access_cache.get(key, (None, 0))
+        if expiration < time.time():
+            has_access = self.user_id.has_group('auth_quick_master.group_auth_quick')
+            _access_cache[key] = (has_access, time.time() + ACCESS_CACHE_TTL)
         if not has_access:
             _logger.info('User doesn\'t have access: %s', self.user_id.login)
         return has_access
@@ -42,11 +68,133 @@ class Token(models.Model):
         self.ensure_one()
         return None
 
+    @api.model
+    def purge_obsolete_tokens(self, batch_size=PURGE_BATCH_SIZE):
+        """Delete tokens, which cannot be used anymore, by batches. Called by cron"""
+        limit = fields.Datetime.now() - relativedelta(minutes=TOKEN_LIFETIME)
+        total = 0
+        while True:
+            self.env.cr.execute("""
+                DELETE FROM auth_quick_master_token
+                WHERE id IN (
+                    SELECT id FROM auth_quick_master_token
+                    WHERE create_date < %s
+                    LIMIT %s
+                )
+            """, (limit, batch_size))
+            deleted = self.env.cr.rowcount
+            total += deleted
+            if deleted < batch_size:
+                break
+            if not getattr(threading.currentThread(), 'testing', False):
+                # release locks between batches
+                self.env.cr.commit()
+        self.invalidate_cache()
+        _logger.info('%s obsolete tokens are deleted', total)
+        self.env['auth_quick_master.nonce'].purge_expired()
+        return total
+
+    def _get_signing_key(self, build=None):
+        """Key for stateless tokens. When it's not set, tokens are saved in database.
+
+        :param build: build reference. Tokens are signed by the key of the build,
+                      which is derived from the master key, so the master key never leaves master
+        """
+        key = self.env['ir.config_parameter'].sudo().get_param('auth_quick_master.signing_key')
+        if key and build is not None:
+            return signed_token.derive_key(key, build)
+        return key
+
+    @api.model
+    def issue_token(self, vals):
+        """
+        :return: token value, which is either saved in database or signed
+        """
+        key = self._get_signing_key()
+        if not key or not vals.get('build'):
+            return self.create(vals).token
+        payload = {
+            'build': vals.get('build') and str(vals['build']),
+            'build_login': vals.get('build_login'),
+            'build_user_id': vals.get('build_user_id') and int(vals['build_user_id']),
+            'user_id': vals.get('user_id') or self.env.user.id,
+            'exp': int(time.time()) + TOKEN_LIFETIME * 60,
+            'nonce': uuid.uuid4().hex,
+        }
+        self._on_signed_token_issued(payload)
+        return signed_token.sign(payload, signed_token.derive_key(key, payload['build']))
+
+    def _on_signed_token_issued(self, payload):
+        """To be extended"""
+        pass
+
+    @api.model
+    def check_signed_token(self, token):
+        """Same checks as for saved tokens, but without database lookup.
+        Revoked tokens are listed in comma-separated system parameter auth_quick_master.revoked_tokens
+
+        :return: payload
+        :raise signed_token.InvalidToken:
+        """
+        if not self._get_signing_key():
+            raise signed_token.InvalidToken('Signed tokens are disabled')
+        revoked = self.env['ir.config_parameter'].sudo().get_param('auth_quick_master.revoked_tokens') or ''
+        payload = signed_token.verify(
+            token, lambda p: self._get_signing_key(p.get('build') or ''), self.env['auth_quick_master.nonce'].sudo(),
+            revoked=set(revoked.split(',')) - {''})
+        if not self.new({'user_id': payload['user_id']}).user_has_access():
+            raise signed_token.InvalidToken('User doesn\'t have access')
+        return payload
+
+    @api.model
+    def redirect_to_build(self, url):
+        """Response, which opens the url. Set system parameter auth_quick_master.direct_redirect
+        to redirect by HTTP 302 without intermediate page"""
+        direct = self.env['ir.config_parameter'].sudo().get_param('auth_quick_master.direct_redirect')
+        return build_redirection(url, direct=bool(direct and direct not in ('0', 'False')))
+
     def redirect_with_token(self, build_url, build_id, build_login):
-        token_obj = self.create({
+        token = self.issue_token({
             'build': build_id,
             'build_login': build_login,
         })
-        url = urllib.parse.urljoin(build_url, '/auth_quick/check-token?token={}'.format(token_obj.token))
+        url = urllib.parse.urljoin(build_url, '/auth_quick/check-token?token={}'.format(token))
+
+        return self.redirect_to_build(url)
+
+
+class UsedNonce(models.Model):
+    _name = 'auth_quick_master.nonce'
+    _description = 'Used Signed Token'
+    _log_access = False
+
+    nonce = fields.Char(required=True)
+    expiration = fields.Datetime(required=True, index=True)
+
+    _sql_constraints = [
+        ('nonce_uniq', 'unique (nonce)', 'Token is already used'),
+    ]
+
+    @api.model
+    def add(self, nonce, expiration):
+        """Same as signed_token.ReplayCache.add, but used nonces are shared by all workers and survive restarts
+
+        :param expiration: timestamp, after which the token is not accepted anyway
+        :return: False if the nonce is already used
+        """
+        if not nonce:
+            return False
+        # waits for concurrent transactions with the same nonce
+        self.env.cr.execute("""
+            INSERT INTO auth_quick_master_nonce (nonce, expiration)
+            VALUES (%s, to_timestamp(%s) AT TIME ZONE 'UTC')
+            ON CONFLICT (nonce) DO NOTHING
+        """, (nonce, expiration))
+        return bool(self.env.cr.rowcount)
 
-        return build_redirection(url)
+    @api.model
+    def purge_expired(self):
+        """Nonces are needed only until their tokens are expired"""
+        self.env.cr.execute("DELETE FROM auth_quick_master_nonce WHERE expiration < NOW() AT TIME ZONE 'UTC'")
+        _logger.info('%s expired nonces are deleted', self.env.cr.rowcount)
+        self.invalidate_cache()
@@ -0,0 +1,95 @@
+# License AGPL-3.0 or later (https://www.gnu.org/licenses/agpl.html).
+import time
+import uuid
+
+from odoo.tests.common import tagged, TransactionCase
+from odoo.addons.auth_quick_master.tools import signed_token
+
+MASTER_KEY = 'master-signing-key'
+
+
+@tagged('post_install', 'at_install')
+class TestSignedToken(TransactionCase):
+
+    def setUp(self):
+        super(TestSignedToken, self).setUp()
+        self.env['ir.config_parameter'].set_param('auth_quick_master.signing_key', MASTER_KEY)
+        self.env.user.groups_id |= self.env.ref('auth_quick_master.group_auth_quick')
+        self.Token = self.env['auth_quick_master.token']
+
+    def payload(self, **kwargs):
+        return dict({
+            'build': '1',
+            'build_login': 'admin',
+            'build_user_id': None,
+            'user_id': self.env.user.id,
+            'exp': int(time.time()) + 60,
+            'nonce': uuid.uuid4().hex,
+        }, **kwargs)
+
+    def test_build_key(self):
+        build_key = self.Token._get_signing_key('1')
+        self.assertEqual(build_key, signed_token.derive_key(MASTER_KEY, '1'))
+        self.assertNotEqual(build_key, self.Token._get_signing_key('2'))
+
+        token = signed_token.sign(self.payload(), build_key)
+        self.assertEqual(self.Token.check_signed_token(token)['build'], '1')
+
+        # key of a build cannot be used to sign tokens for other builds
+        forged = signed_token.sign(self.payload(build='2'), build_key)
+        with self.assertRaises(signed_token.InvalidToken):
+            self.Token.check_signed_token(forged)
+        # tokens are never signed by the master key itself
+        with self.assertRaises(signed_token.InvalidToken):
+            self.Token.check_signed_token(signed_token.sign(self.payload(), MASTER_KEY))
+
+    def test_tampered_signature(self):
+        token = signed_token.sign(self.payload(), 'key')
+        body, signature = token.split('.')
+        forged_body = signed_token.sign(self.payload(user_id=1), 'key').split('.')[0]
+        for tampered in ['%s.%s' % (forged_body, signature), '%s.%s' % (body, signature[::-1]), body, 'not.a.token']:
+            with self.assertRaises(signed_token.InvalidToken):
+                signed_token.verify(tampered, 'key')
+        self.assertEqual(signed_token.verify(token, 'key')['build'], '1')
+
+    def test_expired_token(self):
+        token = signed_token.sign(self.payload(exp=int(time.time()) - 1), 'key')
+        with self.assertRaises(signed_token.InvalidToken):
+            signed_token.verify(token, 'key')
+        token = signed_token.sign(self.payload(), 'key')
+        with self.assertRaises(signed_token.InvalidToken):
+            signed_token.verify(token, 'key', now=time.time() + 120)
+
+    def test_replay(self):
+        replay_cache = signed_token.ReplayCache()
+        token = signed_token.sign(self.payload(), 'key')
+        signed_token.verify(token, 'key', replay_cache)
+        with self.assertRaises(signed_token.InvalidToken):
+            signed_token.verify(token, 'key', replay_cache)
+
+        # master remembers used tokens in database, so they are rejected by all workers
+        token = signed_token.sign(self.payload(), self.Token._get_signing_key('1'))
+        self.Token.check_signed_token(token)
+        with self.assertRaises(signed_token.InvalidToken):
+            self.Token.check_signed_token(token)
+        Nonce = self.env['auth_quick_master.nonce']
+        nonce = signed_token.verify(token, self.Token._get_signing_key('1'))['nonce']
+        self.assertTrue(Nonce.search([('nonce', '=', nonce)]))
+        Nonce.create({'nonce': 'expired', 'expiration': '2000-01-01 00:00:00'})
+        Nonce.purge_expired()
+        self.assertFalse(Nonce.search([('nonce', '=', 'expired')]))
+
+    def test_revoked(self):
+        payload = self.payload()
+        token = signed_token.sign(payload, self.Token._get_signing_key('1'))
+        # tokens of the old key are rejected once the key is changed
+        self.env['ir.config_parameter'].set_param('auth_quick_master.signing_key', 'new-' + MASTER_KEY)
+        with self.assertRaises(signed_token.InvalidToken):
+            self.Token.check_signed_token(token)
+        self.env['ir.config_parameter'].set_param('auth_quick_master.signing_key', MASTER_KEY)
+
+        self.env['ir.config_parameter'].set_param('auth_quick_master.revoked_tokens', 'other,%s' % payload['nonce'])
+        with self.assertRaises(signed_token.InvalidToken):
+            self.Token.check_signed_token(token)
+        self.env['ir.config_parameter'].set_param('auth_quick_master.revoked_tokens', '')
+        self.assertEqual(self.Token.check_signed_token(token)['nonce'], payload['nonce'])
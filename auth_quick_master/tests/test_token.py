@@ -0,0 +1,66 @@
+# License AGPL-3.0 or later (https://www.gnu.org/licenses/agpl.html).
+import time
+
+from odoo.tests.common import tagged, TransactionCase
+from odoo.addons.auth_quick_master.models import token as token_module
+from odoo.addons.auth_quick_master.tools.build_redirection import build_redirection
+
+
+@tagged('post_install', 'at_install')
+class TestToken(TransactionCase):
+
+    def setUp(self):
+        super(TestToken, self).setUp()
+        self.Token = self.env['auth_quick_master.token']
+
+    def test_purge_obsolete_tokens(self):
+        tokens = self.Token.create([{'build': '1'} for i in range(3)])
+        obsolete = tokens[:2]
+        self.env.cr.execute(
+            "UPDATE auth_quick_master_token SET create_date = create_date - interval '1 hour' WHERE id IN %s",
+            (tuple(obsolete.ids),))
+        tokens.invalidate_cache()
+        self.assertTrue(all(t.is_obsolete() for t in obsolete))
+
+        # batches are deleted until nothing is left
+        self.assertEqual(self.Token.purge_obsolete_tokens(batch_size=1), 2)
+        self.assertEqual(tokens.exists(), tokens[2])
+        self.assertEqual(self.Token.purge_obsolete_tokens(), 0)
+
+    def test_access_cache(self):
+        group = self.env.ref('auth_quick_master.group_auth_quick')
+        user = self.env['res.users'].create({
+            'name': 'Quick Auth User',
+            'login': 'quick_auth_user',
+            'groups_id': [(4, group.id)],
+        })
+        token = self.Token.new({'user_id': user.id})
+        key = (self.env.cr.dbname, user.id)
+        token_module._access_cache.pop(key, None)
+        self.assertTrue(token.user_has_access())
+        has_access, expiration = token_module._access_cache[key]
+        self.assertTrue(has_access)
+        self.assertAlmostEqual(expiration, time.time() + token_module.ACCESS_CACHE_TTL, delta=5)
+
+        # result is reused until it's expired
+        user.groups_id -= group
+        self.assertTrue(token.user_has_access())
+        token_module._access_cache[key] = (has_access, time.time() - 1)
+        self.assertFalse(token.user_has_access())
+        self.assertFalse(token_module._access_cache[key][0])
+        token_module._access_cache.pop(key, None)
+
+    def test_build_redirection(self):
+        url = 'http://build.example.com/auth_quick/check-token?token=secret'
+        for response in [build_redirection(url), self.Token.redirect_to_build(url)]:
+            self.assertEqual(response.status_code, 200)
+            self.assertIn(url, response.get_data(as_text=True))
+            self.assertEqual(response.headers['Cache-Control'], 'no-store')
+            self.assertEqual(response.headers['Referrer-Policy'], 'no-referrer')
+
+        self.env['ir.config_parameter'].set_param('auth_quick_master.direct_redirect', '1')
+        for response in [build_redirection(url, direct=True), self.Token.redirect_to_build(url)]:
+            self.assertEqual(response.status_code, 302)
+            self.assertEqual(response.headers['Location'], url)
+            self.assertEqual(response.headers['Cache-Control'], 'no-store')
+            self.assertEqual(response.headers['Referrer-Policy'], 'no-referrer')
@@ -1,2 +1,3 @@
 # License AGPL-3.0 or later (https://www.gnu.org/licenses/agpl.html).
-from . import build_redirection
\ No newline at end of file
+from . import build_redirection
+from . import signed_token
@@ -2,11 +2,31 @@
 # License AGPL-3.0 or later (https://www.gnu.org/licenses/agpl.html).
 import jinja2
 import os
+import werkzeug.utils
+import werkzeug.wrappers
 
+# template is compiled once per process
+_TEMPLATE = jinja2.Environment(
+    loader=jinja2.FileSystemLoader(os.path.realpath(os.path.join(os.path.dirname(__file__), '..', 'views'))),
+    autoescape=True,
+).get_template('auth_quick_master_redirect.html')
 
-def build_redirection(build_url):
-    path = os.path.realpath(os.path.join(os.path.dirname(__file__), '..', 'views'))
-    loader = jinja2.FileSystemLoader(path)
-    env = jinja2.Environment(loader=loader, autoescape=True)
+# urls contain one-time tokens, so responses must not be cached or leaked via Referer header
+HEADERS = [
+    ('Cache-Control', 'no-store'),
+    ('Referrer-Policy', 'no-referrer'),
+]
 
-    return env.get_template('auth_quick_master_redirect.html').render({'build_url': build_url})
+
+def build_redirection(build_url, direct=False):
+    """
+    :param direct: redirect with HTTP 302 instead of the page, which opens the url by javascript
+    :return: response
+    """
+    if direct:
+        response = werkzeug.utils.redirect(build_url, 302)
+    else:
+        response = werkzeug.wrappers.Response(_TEMPLATE.render(build_url=build_url),
+                                              content_type='text/html; charset=utf-8')
+    response.headers.extend(HEADERS)
+    return response
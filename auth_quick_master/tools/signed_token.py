@@ -0,0 +1,96 @@
+# License AGPL-3.0 or later (https://www.gnu.org/licenses/agpl.html).
+"""Stateless tokens: payload is signed by a key shared between master and builds,
+so the token can be checked without looking it up in master database.
+
+The module doesn't depend on odoo and may be copied to builds to verify tokens locally.
+"""
+import base64
+import hashlib
+import hmac
+import json
+import threading
+import time
+
+
+class InvalidToken(Exception):
+    pass
+
+
+def _b64encode(data):
+    return base64.urlsafe_b64encode(data).rstrip(b'=').decode()
+
+
+def _b64decode(data):
+    return base64.urlsafe_b64decode(data + '=' * (-len(data) % 4))
+
+
+def is_signed(token):
+    return '.' in (token or '')
+
+
+def derive_key(key, build):
+    """Key of a single build. Builds get only their own keys, so a build admin cannot sign tokens for other builds"""
+    return hmac.new(key.encode(), str(build).encode(), hashlib.sha256).hexdigest()
+
+
+def sign(payload, key):
+    """
+    :param payload: dict with ``exp`` (expiration timestamp) and ``nonce`` (unique string)
+    """
+    body = _b64encode(json.dumps(payload, sort_keys=True, separators=(',', ':')).encode())
+    signature = hmac.new(key.encode(), body.encode(), hashlib.sha256).digest()
+    return '%s.%s' % (body, _b64encode(signature))
+
+
+def verify(token, key, replay_cache=None, revoked=(), now=None):
+    """
+    :param key: key or function, which returns the key for not yet verified payload
+    :param replay_cache: object with ``add(nonce, expiration)`` method like :class:`ReplayCache`
+                         to accept each token only once
+    :param revoked: nonces of tokens, which must not be accepted
+    :return: payload
+    :raise InvalidToken:
+    """
+    try:
+        body, signature = token.split('.', 1)
+        payload = json.loads(_b64decode(body).decode())
+        if not isinstance(payload, dict):
+            raise ValueError('payload is not an object')
+        if callable(key):
+            key = key(payload)
+        expected = hmac.new(key.encode(), body.encode(), hashlib.sha256).digest()
+        if not hmac.compare_digest(expected, _b64decode(signature)):
+            raise InvalidToken('Token signature is wrong')
+    except (ValueError, TypeError) as e:
+        raise InvalidToken('Token is malformed: %s' % e)
+    if payload.get('exp', 0) < (now or time.time()):
+        raise InvalidToken('Token is obsolete')
+    if payload.get('nonce') in revoked:
+        raise InvalidToken('Token is revoked')
+    if replay_cache is not None and not replay_cache.add(payload.get('nonce'), payload['exp']):
+        raise InvalidToken('Token is already used')
+    return payload
+
+
+class ReplayCache(object):
+    """Nonces of used tokens in memory of the process. They are kept until the tokens are expired, so memory is
+    bounded by the number of tokens issued during token lifetime. Suitable for a single process only"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._nonces = {}
+        self._purge_at = 1000
+
+    def add(self, nonce, expiration):
+        """
+        :return: False if the nonce is already used
+        """
+        now = time.time()
+        with self._lock:
+            if len(self._nonces) > self._purge_at:
+                self._nonces = {n: exp for n, exp in self._nonces.items() if exp >= now}
+                self._purge_at = max(1000, 2 * len(self._nonces))
+            if not nonce or self._nonces.get(nonce, 0) >= now:
+                return False
+            self._nonces[nonce] = expiration
+            return True
@@ -8,7 +8,7 @@
     "category": "SaaS",
     # "live_test_url": "http://apps.it-projects.info/shop/product/DEMO-URL?version=12.0",
     "images": [],
-    "version": "12.0.2.3.0",
+    "version": "12.0.2.20.1",
     "application": False,
 
     "author": "IT-Projects LLC, Ivan Yelizariev",
@@ -34,7 +34,9 @@
         "views/saas_module_views.xml",
         "views/saas_db_views.xml",
         "wizard/saas_template_create_build_view.xml",
+        "wizard/saas_template_create_builds_view.xml",
         "data/ir_cron_data.xml",
+        "data/queue_job_channel_data.xml",
         "data/saas_operator_data.xml",
         "data/default_modules.xml",
         "data/db_sequence.xml",
@@ -0,0 +1,31 @@
+# License AGPL-3.0 or later (https://www.gnu.org/licenses/agpl.html).
+"""Evaluation of initialization code without creating ir.actions.server records"""
+from collections import defaultdict
+import string
+
+from odoo.tools.safe_eval import safe_eval
+
+
+class SafeDict(defaultdict):
+    def __missing__(self, key):
+        return '{' + key + '}'
+
+
+def format_code(code, key_values):
+    """Substitute ``{key}`` placeholders, unknown keys are left as is"""
+    return string.Formatter().vformat(code, (), SafeDict(**key_values))
+
+
+def run_code(env, code, name='Code Eval'):
+    """Execute code in the environment the same way as Server Actions do,
+    but the action is not saved to database"""
+    if not (code or '').strip():
+        return
+    action = env['ir.actions.server'].new({
+        'name': name,
+        'state': 'code',
+        'model_id': env.ref('base.model_res_users').id,
+        'code': code,
+    })
+    eval_context = env['ir.actions.server']._get_eval_context(action)
+    safe_eval(code.strip(), eval_context, mode='exec', nocopy=True)
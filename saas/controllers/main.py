@@ -1,10 +1,12 @@
 # Copyright 2018 Ivan Yelizariev <https://it-projects.info/team/yelizariev>
 # Copyright 2019 Denis Mudarisov <https://it-projects.info/team/trojikman>
 # License AGPL-3.0 or later (https://www.gnu.org/licenses/agpl.html).
+import hmac
 
 import odoo
 from odoo.http import route, request
-from odoo.addons.auth_quick_master.tools.build_redirection import build_redirection
+from odoo.addons.auth_quick_master.controllers.main import AuthQuickMaster
+from .. import metrics
 
 
 class SaasController(odoo.http.Controller):
@@ -13,4 +15,32 @@ class SaasController(odoo.http.Controller):
         if not build_id:
             return False
         build_url = request.env['saas.db'].browse(build_id).get_url() + '/auth_quick/login?build_login=admin'
-        return build_redirection(build_url)
+        return request.env['auth_quick_master.token'].redirect_to_build(build_url)
+
+    @route('/saas/metrics', type='http', auth='public')
+    def metrics(self, token=None, **kwargs):
+        # the endpoint is disabled until the token is set
+        expected = request.env['ir.config_parameter'].sudo().get_param('saas.metrics_token')
+        auth_header = request.httprequest.headers.get('Authorization', '')
+        if auth_header.startswith('Bearer '):
+            token = auth_header[len('Bearer '):]
+        if not expected or not token or not hmac.compare_digest(token, expected):
+            return request.not_found()
+        gauges = request.env['saas.operator'].sudo().get_metrics_gauges()
+        return request.make_response(metrics.render(gauges), headers=[
+            ('Content-Type', 'text/plain; version=0.0.4; charset=utf-8'),
+            ('Cache-Control', 'no-store'),
+        ])
+
+
+class AuthQuickMasterMetrics(AuthQuickMaster):
+
+    @route()
+    @metrics.timed('saas_auth_quick_request', route='get_token')
+    def get_token(self, *args, **kwargs):
+        return super(AuthQuickMasterMetrics, self).get_token(*args, **kwargs)
+
+    @route()
+    @metrics.timed('saas_auth_quick_request', route='check_token')
+    def check_token(self, *args, **kwargs):
+        return super(AuthQuickMasterMetrics, self).check_token(*args, **kwargs)
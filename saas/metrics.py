@@ -0,0 +1,125 @@
+# License AGPL-3.0 or later (https://www.gnu.org/licenses/agpl.html).
+"""Counters and latency histograms in Prometheus text exposition format.
+
+Values are kept in memory of the process, so each worker reports its own numbers with ``pid`` label.
+"""
+from collections import defaultdict
+from contextlib import contextmanager
+from functools import wraps
+import bisect
+import os
+import threading
+import time
+
+# upper bounds of histogram buckets, in seconds
+BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, float('inf'))
+
+_lock = threading.Lock()
+# (name, labels) -> value
+_counters = defaultdict(float)
+# (name, labels) -> [count per bucket, sum]
+_histograms = {}
+# name -> description
+_help = {}
+
+
+def _labels_key(labels):
+    return tuple(sorted((labels or {}).items()))
+
+
+def inc(name, labels=None, value=1, description=None):
+    if description:
+        _help.setdefault(name, description)
+    with _lock:
+        _counters[(name, _labels_key(labels))] += value
+
+
+def observe(name, seconds, labels=None, description=None):
+    if description:
+        _help.setdefault(name, description)
+    key = (name, _labels_key(labels))
+    with _lock:
+        hist = _histograms.setdefault(key, [[0] * len(BUCKETS), 0.0])
+        hist[0][bisect.bisect_left(BUCKETS, seconds)] += 1
+        hist[1] += seconds
+
+
+@contextmanager
+def timer(name, **labels):
+    """Count calls as ``<name>_total`` with ``status`` label and observe duration as ``<name>_seconds``"""
+    start = time.time()
+    status = 'ok'
+    try:
+        yield
+    except Exception:
+        status = 'error'
+        raise
+    finally:
+        observe(name + '_seconds', time.time() - start, labels, 'Duration of %s' % name)
+        inc(name + '_total', dict(labels, status=status), description='Number of %s calls' % name)
+
+
+def timed(name, **labels):
+    """Decorator version of :func:`timer`"""
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            with timer(name, **labels):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (k, _escape(v)) for k, v in labels)
+
+
+def _format_bound(bound):
+    return '+Inf' if bound == float('inf') else repr(float(bound))
+
+
+def render(gauges=None):
+    """
+    :param gauges: list of (name, description, [(labels dict, value)])
+    :return: text in Prometheus exposition format
+    """
+    pid = ('pid', str(os.getpid()))
+    lines = []
+    with _lock:
+        counters = sorted(_counters.items())
+        histograms = sorted((k, (list(v[0]), v[1])) for k, v in _histograms.items())
+
+    seen = set()
+
+    def header(name, metric_type):
+        if name in seen:
+            return
+        seen.add(name)
+        if name in _help:
+            lines.append('# HELP %s %s' % (name, _help[name]))
+        lines.append('# TYPE %s %s' % (name, metric_type))
+
+    for (name, labels), value in counters:
+        header(name, 'counter')
+        lines.append('%s%s %s' % (name, _format_labels(labels + (pid,)), value))
+    for (name, labels), (buckets, total) in histograms:
+        header(name, 'histogram')
+        cumulative = 0
+        for bound, count in zip(BUCKETS, buckets):
+            cumulative += count
+            lines.append('%s_bucket%s %s' % (
+                name, _format_labels(labels + (pid, ('le', _format_bound(bound)))), cumulative))
+        lines.append('%s_sum%s %s' % (name, _format_labels(labels + (pid,)), total))
+        lines.append('%s_count%s %s' % (name, _format_labels(labels + (pid,)), cumulative))
+    for name, description, values in gauges or []:
+        lines.append('# HELP %s %s' % (name, description))
+        lines.append('# TYPE %s gauge' % name)
+        for labels, value in values:
+            lines.append('%s%s %s' % (name, _format_labels(_labels_key(labels)), value))
+    return '\n'.join(lines) + '\n'
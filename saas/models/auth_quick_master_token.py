@@ -1,6 +1,6 @@
 # Copyright 2018 Ivan Yelizariev <https://it-projects.info/team/yelizariev>
 # License AGPL-3.0 or later (https://www.gnu.org/licenses/agpl.html).
-from odoo import models, api
+from odoo import models, fields, api
 
 
 class Token(models.Model):
@@ -10,4 +10,25 @@ class Token(models.Model):
     def create(self, vals):
         res = super(Token, self).create(vals)
         self.env['saas.log'].log_db_authed(res)
+        self._on_build_access(res.build)
         return res
+
+    def _on_signed_token_issued(self, payload):
+        super(Token, self)._on_signed_token_issued(payload)
+        self.env['saas.log'].log_db_authed_signed(payload)
+        self._on_build_access(payload['build'])
+
+    @api.model
+    def _on_build_access(self, build_id):
+        build = self.env['saas.db'].sudo().browse(int(build_id))
+        now = fields.Datetime.now()
+        if build.exists() and not build.last_access:
+            # time that user waited for the build since the request.
+            # Spare builds are requested, when they are taken from the pool
+            requested = build.claim_date or build.create_date
+            self.env['saas.db.phase'].sudo().record(build, [
+                ('first_login', (now - requested).total_seconds()),
+            ])
+        build.write({
+            'last_access': now,
+        })
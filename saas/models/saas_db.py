@@ -1,8 +1,22 @@
 # Copyright 2018 Ivan Yelizariev <https://it-projects.info/team/yelizariev>
 # Copyright 2019 Denis Mudarisov <https://it-projects.info/team/trojikman>
 # License AGPL-3.0 or later (https://www.gnu.org/licenses/agpl.html).
+from contextlib import contextmanager, ExitStack
+import logging
+
 from odoo import models, fields, api
 from odoo.addons.queue_job.job import job
+from .. import metrics
+
+_logger = logging.getLogger(__name__)
+
+# number of expired builds dropped by a single job
+EXPIRED_BATCH_SIZE = 50
+# hours after which builds are queued for dropping again, when their dropping job is failed
+DROPPING_TIMEOUT = 1
+# lifetime in hours of builds without template, e.g. created before builds were linked to templates.
+# May be changed via system parameter saas.build_ttl
+BUILD_TTL = 0
 
 
 class SAASDB(models.Model):
@@ -14,35 +28,108 @@ class SAASDB(models.Model):
     type = fields.Selection([
         ('template', 'Template DB'),
         ('build', 'Normal Build'),
+        ('spare', 'Spare Build'),
     ], string='DB Type', default='build')
+    template_operator_id = fields.Many2one('saas.template.operator', 'Template\'s Deployment', ondelete='set null')
     state = fields.Selection([
         ('draft', 'Draft'),
+        ('duplicating', 'Database Copying'),
+        ('post_init', 'Extra initialization'),
         ('done', 'Ready'),
+        ('dropping', 'Dropping'),
+        ('failed', 'Failed'),
     ], default='draft')
+    last_access = fields.Datetime('Last Access', readonly=True, help='Last quick authentication in the build')
+    claim_date = fields.Datetime(
+        'Claimed', readonly=True, copy=False,
+        help='Time when the spare build was taken from the pool')
+    phase_ids = fields.One2many('saas.db.phase', 'db_id', 'Timeline', readonly=True)
 
     @api.multi
     def unlink(self):
         self.drop_db()
+        self.env['saas.log.daily']._merge_dbs(self.ids)
         return super(SAASDB, self).unlink()
 
     @api.multi
     @job
-    def create_db(self, template_db, demo, lang='en_US', callback_obj=None, callback_method=None):
+    @metrics.timed('saas_db_create')
+    def create_db(self, template_db, demo, lang='en_US', callback_obj=None, callback_method=None, callback_args=None):
         self.ensure_one()
-        db_name = self.name
-        self.operator_id._create_db(template_db, db_name, demo, lang)
-        self.state = 'done'
-        self.env['saas.log'].log_db_created(self)
-        if callback_obj and callback_method:
-            getattr(callback_obj, callback_method)()
+        with ExitStack() as stack:
+            if self.type != 'template':
+                # users, who wait for the build, get an error instead of endless waiting.
+                # Failed jobs of template databases are kept failed to be requeued
+                stack.enter_context(self._fail_on_error())
+            db_name = self.name
+            timings = self.operator_id._create_db(
+                template_db, db_name, demo, lang, is_template=self.type == 'template')
+            # builds are ready only after build_post_init
+            self.state = 'done' if self.type == 'template' else 'post_init'
+            self.env['saas.log'].log_db_created(self, timings)
+            self.env['saas.db.phase'].record(self, timings)
+            if callback_obj and callback_method:
+                getattr(callback_obj, callback_method)(*(callback_args or []))
+
+    @contextmanager
+    def _fail_on_error(self):
+        """Mark the databases as failed, when the block raises, instead of leaving them in intermediate state
+        without a job to finish them. Changes and events of the block are rolled back,
+        the error is logged and not raised"""
+        try:
+            with self.env['saas.log']._savepoint():
+                yield
+        except Exception as e:
+            self.invalidate_cache()
+            _logger.exception('Preparation of %s is failed', ', '.join(self.mapped('name')))
+            self.write({'state': 'failed'})
+            self.env['saas.log'].log_db_failed(self, str(e) or e.__class__.__name__)
 
     @api.multi
     @job
+    @metrics.timed('saas_db_drop')
     def drop_db(self):
-        for r in self:
-            r.operator_id._drop_db(r.name)
-            self.state = 'draft'
-            self.env['saas.log'].log_db_dropped(self)
+        for operator in self.mapped('operator_id'):
+            operator._drop_dbs(self.filtered(lambda r: r.operator_id == operator).mapped('name'))
+        self.write({'state': 'draft'})
+        self.env['saas.log'].log_db_dropped(self)
+
+    @api.multi
+    @job
+    def unlink_expired(self):
+        # builds may be deleted manually while the job is waiting
+        self.exists().unlink()
+
+    @api.model
+    def reap_expired_builds(self, batch_size=EXPIRED_BATCH_SIZE):
+        """Queue dropping of builds, which are not accessed longer than Build Lifetime of their templates.
+        Builds without template live for saas.build_ttl hours.
+        Builds, which are still not dropped after DROPPING_TIMEOUT, are queued again. Called by cron"""
+        default_ttl = int(self.env['ir.config_parameter'].sudo().get_param('saas.build_ttl', BUILD_TTL))
+        self.env.cr.execute("""
+            SELECT db.id
+            FROM saas_db db
+            LEFT JOIN saas_template_operator t_op ON t_op.id = db.template_operator_id
+            LEFT JOIN saas_template t ON t.id = t_op.template_id
+            WHERE db.type = 'build'
+              AND (
+                db.state = 'done'
+                AND COALESCE(t.build_ttl, %(default_ttl)s) > 0
+                AND COALESCE(db.last_access, db.create_date)
+                    + COALESCE(t.build_ttl, %(default_ttl)s) * INTERVAL '1 hour' < NOW() AT TIME ZONE 'UTC'
+                OR db.state = 'dropping'
+                AND db.write_date + %(dropping_timeout)s * INTERVAL '1 hour' < NOW() AT TIME ZONE 'UTC'
+              )
+            ORDER BY db.operator_id, db.id
+        """, {'default_ttl': default_ttl, 'dropping_timeout': DROPPING_TIMEOUT})
+        expired = self.browse([row[0] for row in self.env.cr.fetchall()])
+        # don't queue the same builds on next cron call, unless their job is failed
+        expired.write({'state': 'dropping'})
+        for operator in expired.mapped('operator_id'):
+            builds = expired.filtered(lambda r: r.operator_id == operator)
+            for i in range(0, len(builds), batch_size):
+                builds[i:i + batch_size].with_delay(channel=operator.job_channel()).unlink_expired()
+        return expired
 
     def get_url(self):
         # TODO: need possibility to use custom domain
@@ -56,3 +143,36 @@ class SAASDB(models.Model):
             'target': 'new',
             'url': auth_url,
         }
+
+
+class SAASDBPhase(models.Model):
+    _name = 'saas.db.phase'
+    _description = 'Phase of Database Preparation'
+    _order = 'id'
+
+    name = fields.Char('Phase', required=True, index=True)
+    duration = fields.Float('Duration, s', digits=(16, 3), group_operator='avg')
+    description = fields.Char('Extra data')
+    db_id = fields.Many2one('saas.db', 'Database', ondelete='cascade', index=True)
+    db_type = fields.Selection(related='db_id.type', store=True, string='DB Type')
+    operator_id = fields.Many2one(related='db_id.operator_id', store=True, string='Operator')
+    template_operator_id = fields.Many2one(
+        'saas.template.operator', "Template's Deployment", ondelete='cascade', index=True,
+        help='Set for phases of template database preparation')
+
+    @api.model
+    def record(self, db, timings, template_operator=None, description=None):
+        """
+        :param timings: list of (phase, seconds) pairs
+        :param template_operator: deployment, which template database is prepared.
+                                  Found automatically for template databases
+        """
+        if template_operator is None and db.type == 'template':
+            template_operator = self.env['saas.template.operator'].search([('operator_db_id', '=', db.id)], limit=1)
+        return self.create([{
+            'name': name,
+            'duration': seconds,
+            'description': description,
+            'db_id': db.id,
+            'template_operator_id': template_operator and template_operator.id,
+        } for name, seconds in timings])
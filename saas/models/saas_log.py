@@ -1,11 +1,25 @@
 # Copyright 2018 Ivan Yelizariev <https://it-projects.info/team/yelizariev>
 # License AGPL-3.0 or later (https://www.gnu.org/licenses/agpl.html).
+from contextlib import contextmanager
+from datetime import timedelta
 import logging
+import threading
 
-from odoo import models, fields
+import psycopg2
+
+from odoo import models, fields, api, registry, tools
 
 _logger = logging.getLogger(__name__)
 
+# events older than this number of days are compressed to saas.log.daily.
+# May be changed via system parameter saas.log_retention_days
+LOG_RETENTION_DAYS = 90
+# number of events in one INSERT query
+FLUSH_BATCH_SIZE = 1000
+
+LOG_COLUMNS = ['type', 'data_id', 'description', 'db_id', 'user_id', 'create_uid', 'write_uid', 'create_date',
+               'write_date']
+
 
 class SAASLog(models.Model):
     _name = 'saas.log'
@@ -16,45 +30,225 @@ class SAASLog(models.Model):
         ('created', 'DB is created'),
         ('authed', 'Quick Authentication'),
         ('dropped', 'DB is dropped'),
-    ], string='Log type')
+        ('master_url', 'Master URL is updated'),
+        ('master_url_failed', 'Master URL update is failed'),
+        ('failed', 'DB preparation is failed'),
+    ], string='Log type', index=True)
     data_id = fields.Reference(string='Reference', selection=[
         ('auth_quick_master.token', 'Token'),
         ('saas.operator', 'Operator'),
     ])
     description = fields.Char('Extra data')
-    db_id = fields.Many2one('saas.db')
+    db_id = fields.Many2one('saas.db', index=True)
     user_id = fields.Many2one('res.users', 'User', default=lambda s: s.env.user.id)
 
-    def log_db_creating(self, db, template=None):
-        self.create({
+    def log_db_creating(self, dbs, template=None):
+        self._log([{
             'type': 'creation',
-            'description': 'from template: %s' % template,
+            'description': 'from template: %s' % (template or db.template_operator_id.operator_db_id or None),
             'data_id': 'saas.operator,%s' % db.operator_id.id,
             'db_id': db.id,
-        })
+        } for db in dbs])
 
-    def log_db_created(self, db):
-        self.create({
+    def log_db_created(self, db, timings=None):
+        """
+        :param timings: list of (phase, seconds) pairs
+        """
+        self._log({
             'type': 'created',
+            'description': ', '.join('%s: %.2fs' % t for t in timings or []) or False,
             'data_id': 'saas.operator,%s' % db.operator_id.id,
             'db_id': db.id,
         })
 
     def log_db_authed(self, token_obj):
-        self.create({
+        self._log({
             'type': 'authed',
             'data_id': 'auth_quick_master.token,%s' % token_obj.id,
             'db_id': int(token_obj.build),
             'user_id': token_obj.user_id.id,
         })
 
-    def log_db_dropped(self, db):
-        self.create({
+    def log_db_authed_signed(self, payload):
+        """Signed tokens are not saved, so there is nothing to refer to"""
+        self._log({
+            'type': 'authed',
+            'description': 'signed token',
+            'db_id': int(payload['build']),
+            'user_id': payload['user_id'],
+        })
+
+    def log_db_failed(self, dbs, error):
+        self._log([{
+            'type': 'failed',
+            'description': error,
+            'data_id': 'saas.operator,%s' % db.operator_id.id,
+            'db_id': db.id,
+        } for db in dbs])
+
+    def log_db_dropped(self, dbs):
+        self._log([{
             'type': 'dropped',
             'data_id': 'saas.operator,%s' % db.operator_id.id,
             'db_id': db.id,
-        })
+        } for db in dbs])
+
+    def log_master_url_updated(self, dbs, url, errors):
+        """
+        :param errors: error message or None for each database
+        """
+        self._log([{
+            'type': 'master_url_failed' if error else 'master_url',
+            'description': error or url,
+            'data_id': 'saas.operator,%s' % db.operator_id.id,
+            'db_id': db.id,
+        } for db, error in zip(dbs, errors)])
+
+    @api.model_create_multi
+    def create(self, vals_list):
+        _logger.debug('saas.log: %s', vals_list)
+        return super(SAASLog, self).create(vals_list)
+
+    @api.model
+    def _log(self, vals_list):
+        """Save events after the transaction is committed. Events of rolled back transactions are discarded.
+        Events of rolled back savepoints are discarded only if the savepoint is made by _savepoint"""
+        if isinstance(vals_list, dict):
+            vals_list = [vals_list]
+        if getattr(threading.currentThread(), 'testing', False) and not self.env.context.get('saas_log_buffered'):
+            # nothing is committed in tests
+            self.create(vals_list)
+            return
+        _logger.debug('saas.log (buffered): %s', vals_list)
+        cr = self.env.cr
+        buffer = getattr(cr, '_saas_log_buffer', None)
+        if buffer is None:
+            buffer = cr._saas_log_buffer = []
+            dbname = cr.dbname
+
+            def flush():
+                cr._saas_log_buffer = None
+                self._flush_log_buffer(dbname, buffer)
+
+            def discard():
+                cr._saas_log_buffer = None
+
+            cr.after('commit', flush)
+            cr.after('rollback', discard)
+        now = fields.Datetime.to_string(fields.Datetime.now())
+        for vals in vals_list:
+            row = dict.fromkeys(LOG_COLUMNS, None)
+            row.update(vals, create_uid=self.env.uid, write_uid=self.env.uid, create_date=now, write_date=now)
+            if not row['user_id']:
+                row['user_id'] = self.env.uid
+            buffer.append(row)
+
+    @contextmanager
+    def _savepoint(self):
+        """Same as savepoint of the cursor, but buffered events of the block are discarded too, when it raises"""
+        cr = self.env.cr
+        size = len(getattr(cr, '_saas_log_buffer', None) or [])
+        try:
+            with cr.savepoint():
+                yield
+        except Exception:
+            buffer = getattr(cr, '_saas_log_buffer', None)
+            if buffer:
+                del buffer[size:]
+            raise
+
+    @staticmethod
+    def _flush_log_buffer(dbname, rows):
+        """Insert buffered events by batches. Events of databases deleted meanwhile are saved without reference.
+        If a batch cannot be inserted, events are inserted one by one, so only the broken ones are lost"""
+        try:
+            with registry(dbname).cursor() as cr:
+                for i in range(0, len(rows), FLUSH_BATCH_SIZE):
+                    SAASLog._insert_log_rows(cr, rows[i:i + FLUSH_BATCH_SIZE])
+            return
+        except psycopg2.Error:
+            _logger.warning('Failed to save %s saas.log events at once, saving them one by one', len(rows),
+                            exc_info=True)
+        try:
+            with registry(dbname).cursor() as cr:
+                for row in rows:
+                    try:
+                        with cr.savepoint():
+                            SAASLog._insert_log_rows(cr, [row])
+                    except psycopg2.Error:
+                        _logger.exception('Failed to save saas.log event: %s', row)
+        except psycopg2.Error:
+            _logger.exception('Failed to save %s saas.log events', len(rows))
+
+    @staticmethod
+    def _insert_log_rows(cr, rows):
+        values = ','.join(
+            cr.mogrify('(%s)' % ','.join(['%s'] * len(LOG_COLUMNS)), [row[c] for c in LOG_COLUMNS]).decode()
+            for row in rows)
+        cr.execute("""
+            INSERT INTO saas_log (type, data_id, description, db_id, user_id,
+                                  create_uid, write_uid, create_date, write_date)
+            SELECT v.type, v.data_id, v.description, d.id, v.user_id,
+                   v.create_uid, v.write_uid, v.create_date::timestamp, v.write_date::timestamp
+            FROM (VALUES %s) AS v(%s)
+            LEFT JOIN saas_db d ON d.id = v.db_id
+        """ % (values, ', '.join(LOG_COLUMNS)))
+
+    @api.model
+    def rollup_old_logs(self):
+        """Compress old events into daily counters per database. Called by cron"""
+        days = int(self.env['ir.config_parameter'].sudo().get_param('saas.log_retention_days', LOG_RETENTION_DAYS))
+        cutoff = fields.Datetime.to_string(fields.Datetime.now().replace(hour=0, minute=0, second=0, microsecond=0)
+                                           - timedelta(days=days))
+        self.env.cr.execute("""
+            INSERT INTO saas_log_daily (date, db_id, type, count, create_uid, write_uid, create_date, write_date)
+            SELECT l.create_date::date, l.db_id, l.type, count(*), %(uid)s, %(uid)s,
+                   now() at time zone 'UTC', now() at time zone 'UTC'
+            FROM saas_log l
+            WHERE l.create_date < %(cutoff)s
+            GROUP BY l.create_date::date, l.db_id, l.type
+            ON CONFLICT (date, (COALESCE(db_id, 0)), type) DO UPDATE
+            SET count = saas_log_daily.count + EXCLUDED.count, write_date = EXCLUDED.write_date
+        """, {'uid': self.env.uid, 'cutoff': cutoff})
+        self.env.cr.execute('DELETE FROM saas_log WHERE create_date < %s', (cutoff,))
+        deleted = self.env.cr.rowcount
+        self.invalidate_cache()
+        self.env['saas.log.daily'].invalidate_cache()
+        _logger.info('%s saas.log events older than %s are compressed', deleted, cutoff)
+        return deleted
+
+
+class SAASLogDaily(models.Model):
+    _name = 'saas.log.daily'
+    _description = 'Database Event Daily Statistics'
+    _order = 'date desc'
+
+    date = fields.Date(required=True, index=True)
+    db_id = fields.Many2one('saas.db', ondelete='set null', index=True)
+    type = fields.Selection(lambda self: self.env['saas.log']._fields['type'].selection, string='Log type')
+    count = fields.Integer()
+
+    def _auto_init(self):
+        res = super(SAASLogDaily, self)._auto_init()
+        # NULL values are distinct in unique constraints, so statistics without database are made unique by COALESCE
+        tools.create_unique_index(self._cr, 'saas_log_daily_date_db_type_index', self._table,
+                                  ['date', '(COALESCE(db_id, 0))', 'type'])
+        return res
 
-    def create(self, vals):
-        _logger.debug('saas.log: %s', vals)
-        return super(SAASLog, self).create(vals)
+    @api.model
+    def _merge_dbs(self, db_ids):
+        """Move statistics of the databases to the ones without database. Called before deleting the databases,
+        otherwise reference to them is set to NULL and conflicts with existing statistics"""
+        if not db_ids:
+            return
+        self.env.cr.execute("""
+            INSERT INTO saas_log_daily (date, db_id, type, count, create_uid, write_uid, create_date, write_date)
+            SELECT date, NULL, type, sum(count), %(uid)s, %(uid)s, now() at time zone 'UTC', now() at time zone 'UTC'
+            FROM saas_log_daily
+            WHERE db_id IN %(db_ids)s
+            GROUP BY date, type
+            ON CONFLICT (date, (COALESCE(db_id, 0)), type) DO UPDATE
+            SET count = saas_log_daily.count + EXCLUDED.count, write_date = EXCLUDED.write_date
+        """, {'uid': self.env.uid, 'db_ids': tuple(db_ids)})
+        self.env.cr.execute('DELETE FROM saas_log_daily WHERE db_id IN %s', (tuple(db_ids),))
+        self.invalidate_cache()
@@ -2,14 +2,32 @@
 # Copyright 2019 Denis Mudarisov <https://it-projects.info/team/trojikman>
 # License AGPL-3.0 or later (https://www.gnu.org/licenses/agpl.html).
 from collections import defaultdict
-import string
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import closing
+import logging
+import os
+import shutil
+import subprocess
+import time
 
 from odoo import models, fields, api, tools, SUPERUSER_ID, sql_db, registry
+from odoo.modules.registry import Registry
 from odoo.service import db
 from odoo.service.model import execute
 from odoo.addons.queue_job.job import job
+from ..xmlrpc import RPCSession, rpc_forget, rpc_db
+from ..code_eval import format_code, run_code
+from .. import metrics
 
 MANDATORY_MODULES = ['auth_quick']
+# STRATEGY option of CREATE DATABASE is available since PostgreSQL 15
+PG_STRATEGY_VERSION = 150000
+# number of builds updated by one job on changing Master URL
+DIRECT_URL_CHUNK_SIZE = 100
+# max number of builds updated by one job at the same time
+DIRECT_URL_WORKERS = 8
+
+_logger = logging.getLogger(__name__)
 
 
 class SAASOperator(models.Model):
@@ -20,17 +38,160 @@ class SAASOperator(models.Model):
     # list of types can be extended via selection_add
     type = fields.Selection([
         ('local', 'Same Instance'),
+        ('remote', 'Remote Odoo (XML-RPC)'),
     ], 'Type')
+    remote_url = fields.Char('Remote URL', help='URL of the Odoo server, which hosts the databases')
+    remote_master_password = fields.Char('Remote Master Password')
+    remote_admin_login = fields.Char('Remote Admin Login', default='admin',
+                                     help='Admin user of templates and builds on the remote server')
+    remote_admin_password = fields.Char('Remote Admin Password', default='admin')
     direct_url = fields.Char('Master URL (Server-to-Server)', required=True, help='URL for server-to-server communication ')
     # host = fields.Char()
     # port = fields.Char()
     db_url_template = fields.Char('DB URLs', help='Avaialble variables: {db_id}, {db_name}')
     db_name_template = fields.Char('DB Names', required=True, help='Avaialble variables: {unique_id}')
     template_operator_ids = fields.One2many('saas.template.operator', 'operator_id')
+    weight = fields.Integer(
+        default=1, help='Relative capacity of the operator. Used by Weighted Capacity choice of deployments')
+    max_builds = fields.Integer(
+        'Max Builds', default=0, help='New builds are not created on the operator once it has that many builds. '
+                                      'Set 0 for no limit')
+    template_concurrency = fields.Integer(
+        'Concurrent Template Builds', default=1, help='Max number of templates being prepared at the same time')
+    job_channel_id = fields.Many2one('queue.job.channel', 'Job Channel', readonly=True)
+    job_capacity = fields.Integer(
+        'Heavy Jobs Capacity', default=1,
+        help='Max number of database copying, dropping and modules installation jobs run at the same time')
+    job_channels_config = fields.Char(
+        'Job Channels Config', compute='_compute_job_channels_config',
+        help='Add it to "channels" option of "queue_job" section of odoo config to apply the capacity')
+    clone_strategy = fields.Selection([
+        ('copy', 'Full Copy'),
+        ('hardlink', 'Hard Links'),
+        ('reflink', 'Copy-on-Write'),
+        ('no_filestore', 'Skip Filestore'),
+    ], 'Filestore Cloning', default='copy', required=True,
+        help='How filestore of the template is copied to a build:\n'
+             '* Full Copy: every file is copied\n'
+             '* Hard Links: files are linked to the ones of the template. '
+             'Filestore is content-addressed, so the files are never modified in place. '
+             'Falls back to the full copy if the filestores are on different filesystems\n'
+             '* Copy-on-Write: files are copied with reflinks, if filesystem supports it\n'
+             '* Skip Filestore: only the database is copied. '
+             'Filestore of templates is still copied, with hard links')
+    pg_strategy = fields.Selection([
+        ('file_copy', 'FILE_COPY'),
+        ('wal_log', 'WAL_LOG'),
+    ], 'Database Cloning',
+        help='STRATEGY of CREATE DATABASE. Used only with PostgreSQL 15 or newer. Keep empty to use server default')
+
+    @api.model
+    def create(self, vals):
+        res = super(SAASOperator, self).create(vals)
+        res._create_job_channels()
+        return res
+
+    @api.model
+    def _create_job_channels(self, operators=None):
+        """Create channel with subchannels for heavy and light jobs per operator. Called on module update too"""
+        if operators is None:
+            operators = self.search([('job_channel_id', '=', False)])
+        Channel = self.env['queue.job.channel'].sudo()
+        parent = self.env.ref('saas.channel_saas')
+        for r in operators:
+            channel = Channel.create({
+                'name': 'operator_%s' % r.id,
+                'parent_id': parent.id,
+            })
+            Channel.create([{
+                'name': name,
+                'parent_id': channel.id,
+            } for name in ['heavy', 'light']])
+            r.job_channel_id = channel
+
+    @api.depends('job_capacity')
+    def _compute_job_channels_config(self):
+        for r in self:
+            r.job_channels_config = '%s:%s' % (r.job_channel(), r.job_capacity)
+
+    @api.multi
+    def get_build_counts(self):
+        """
+        :return: dict operator_id -> number of existing builds
+        """
+        counts = defaultdict(int)
+        groups = self.env['saas.db'].read_group([
+            ('operator_id', 'in', self.ids),
+            ('type', 'in', ['build', 'spare']),
+            ('state', '!=', 'draft'),
+        ], ['operator_id'], ['operator_id'])
+        for g in groups:
+            counts[g['operator_id'][0]] = g['operator_id_count']
+        return counts
+
+    @api.multi
+    def get_queued_job_counts(self):
+        """
+        :return: dict operator_id -> number of heavy jobs, which are not finished yet
+        """
+        counts = defaultdict(int)
+        channels = {r.job_channel(): r.id for r in self}
+        groups = self.env['queue.job'].sudo().read_group([
+            ('channel', 'in', list(channels)),
+            ('state', 'in', ['pending', 'enqueued', 'started']),
+        ], ['channel'], ['channel'])
+        for g in groups:
+            counts[channels[g['channel']]] = g['channel_count']
+        return counts
+
+    @api.model
+    def get_metrics_gauges(self):
+        """Current state of the platform for the metrics endpoint
+
+        :return: list of (name, description, [(labels, value)])
+        """
+        builds = self.env['saas.db'].read_group(
+            [('state', '!=', 'draft')], ['operator_id', 'type', 'state'], ['operator_id', 'type', 'state'], lazy=False)
+        deployments = self.env['saas.template.operator'].read_group(
+            [], ['operator_id', 'state'], ['operator_id', 'state'], lazy=False)
+        jobs = self.env['queue.job'].read_group([
+            ('channel', '=like', 'root.saas.%'),
+            ('state', 'in', ['pending', 'enqueued', 'started']),
+        ], ['channel', 'state'], ['channel', 'state'], lazy=False)
+        return [
+            ('saas_databases', 'Number of databases per operator, type and state', [
+                ({'operator': g['operator_id'] and g['operator_id'][0], 'type': g['type'], 'state': g['state']},
+                 g['__count'])
+                for g in builds
+            ]),
+            ('saas_template_deployments', 'Number of template deployments per operator and state', [
+                ({'operator': g['operator_id'] and g['operator_id'][0], 'state': g['state']}, g['__count'])
+                for g in deployments
+            ]),
+            ('saas_queued_jobs', 'Number of unfinished jobs per channel and state', [
+                ({'channel': g['channel'], 'state': g['state']}, g['__count'])
+                for g in jobs
+            ]),
+        ]
+
+    def job_channel(self, heavy=True):
+        """Channel for jobs that work with databases of the operator
+
+        :param heavy: whether the job copies, drops databases or installs modules
+        """
+        self.ensure_one()
+        return 'root.saas.operator_%s.%s' % (self.id, 'heavy' if heavy else 'light')
 
     @api.multi
-    def _create_db(self, template_db, db_name, demo, lang='en_US'):
-        """Synchronous db creation"""
+    def _create_db(self, template_db, db_name, demo, lang='en_US', is_template=False):
+        """Synchronous db creation
+
+        :param is_template: whether the new database is a template too.
+                            Filestore of templates is always copied, so that their copies get it
+        :return: list of (phase, seconds) pairs
+        """
+        timings = []
+        test_enable = None
         if self.type == 'local':
             # to avoid installing extra modules we need this condition
             if tools.config['init']:
@@ -42,32 +203,135 @@ class SAASOperator(models.Model):
                 tools.config['test_enable'] = {}
 
         for r in self:
+            if r.type == 'remote':
+                start = time.time()
+                if template_db:
+                    r._rpc_db('duplicate_database', template_db, db_name)
+                else:
+                    r._rpc_db('create_database', db_name, demo, lang,
+                              r.remote_admin_password, r.remote_admin_login)
+                timings = [('database', time.time() - start)]
+                continue
             if r.type != 'local':
                 continue
 
             if template_db:
-                db._drop_conn(self.env.cr, template_db)
-                db.exp_duplicate_database(template_db, db_name)
+                timings = r._duplicate_db(template_db, db_name, is_template)
             else:
+                start = time.time()
                 db.exp_create_database(
                     db_name, demo, lang)
+                timings = [('database', time.time() - start)]
 
         if test_enable:
             tools.config['test_enable'] = test_enable
+        return timings
+
+    def _duplicate_db(self, template_db, db_name, is_template=False):
+        """Same as exp_duplicate_database, but filestore is copied according to clone_strategy"""
+        self.ensure_one()
+        strategy = self.clone_strategy
+        if is_template and strategy == 'no_filestore':
+            # builds and child templates of the template need its files
+            strategy = 'hardlink'
+        _logger.info('Duplicate database `%s` to `%s` (%s).', template_db, db_name, strategy)
+        timings = []
+
+        start = time.time()
+        sql_db.close_db(template_db)
+        with closing(sql_db.db_connect('postgres').cursor()) as cr:
+            # avoid transaction block
+            cr.autocommit(True)
+            db._drop_conn(cr, template_db)
+            timings.append(('drop_connections', time.time() - start))
+            start = time.time()
+            query = 'CREATE DATABASE "%s" ENCODING \'unicode\' TEMPLATE "%s"' % (db_name, template_db)
+            if self.pg_strategy and cr._cnx.server_version >= PG_STRATEGY_VERSION:
+                query += ' STRATEGY = %s' % self.pg_strategy.upper()
+            cr.execute(query)
+        timings.append(('database', time.time() - start))
+
+        start = time.time()
+        with Registry.new(db_name).cursor() as cr:
+            # if it's a copy of a database, force generation of a new dbuuid
+            env = api.Environment(cr, SUPERUSER_ID, {})
+            env['ir.config_parameter'].init(force=True)
+        timings.append(('registry', time.time() - start))
+
+        start = time.time()
+        self._copy_filestore(tools.config.filestore(template_db), tools.config.filestore(db_name), strategy)
+        timings.append(('filestore', time.time() - start))
+        return timings
+
+    def _copy_filestore(self, from_fs, to_fs, strategy=None):
+        """:param strategy: value of clone_strategy. Strategy of the operator is used by default"""
+        self.ensure_one()
+        strategy = strategy or self.clone_strategy
+        if strategy == 'no_filestore' or not os.path.exists(from_fs) or os.path.exists(to_fs):
+            return
+        if strategy == 'hardlink':
+            try:
+                shutil.copytree(from_fs, to_fs, copy_function=os.link)
+                return
+            except (OSError, shutil.Error) as e:
+                _logger.warning('Cannot create hard links for filestore %s, copy it instead: %s', to_fs, e)
+                shutil.rmtree(to_fs, ignore_errors=True)
+        elif strategy == 'reflink':
+            subprocess.check_call(['cp', '-a', '--reflink=auto', from_fs, to_fs])
+            return
+        shutil.copytree(from_fs, to_fs)
 
     @api.multi
     def _drop_db(self, db_name):
+        self._drop_dbs([db_name])
+
+    @api.multi
+    def _drop_dbs(self, db_names):
+        """Same as exp_drop, but connections to all databases are terminated at once"""
         for r in self:
+            if r.type == 'remote':
+                for name in db_names:
+                    r._rpc_db('drop', name)
+                    rpc_forget(r.remote_url, name)
+                continue
             if r.type != 'local':
                 continue
 
-            db.exp_drop(db_name)
+            existing = set(db.list_dbs(True))
+            # names are filtered per operator, the argument is shared by all of them
+            names = [name for name in db_names if name in existing]
+            if not names:
+                continue
+            for name in names:
+                Registry.delete(name)
+                sql_db.close_db(name)
+            with closing(sql_db.db_connect('postgres').cursor()) as cr:
+                # avoid transaction block
+                cr.autocommit(True)
+                cr.execute("""
+                    SELECT pg_terminate_backend(pid)
+                    FROM pg_stat_activity
+                    WHERE datname IN %s AND pid != pg_backend_pid()
+                """, (tuple(names),))
+                for name in names:
+                    _logger.info('Drop database `%s`.', name)
+                    cr.execute('DROP DATABASE "%s"' % name)
+            for name in names:
+                fs = tools.config.filestore(name)
+                if os.path.exists(fs):
+                    shutil.rmtree(fs)
 
     @job
-    def install_modules(self, template_id, template_operator_id):
+    @metrics.timed('saas_install_modules')
+    def install_modules(self, template_id, template_operator_id, post_init=True):
+        """Install modules of the template, which are not installed yet
+
+        :param post_init: whether to run Template Initialization afterwards
+        """
         self.ensure_one()
-        modules = [module.name for module in template_id.template_module_ids]
-        modules = [('name', 'in', MANDATORY_MODULES + modules)]
+        module_names = MANDATORY_MODULES + template_id._get_module_names()
+        modules = [('name', 'in', module_names)]
+        start = time.time()
         if self.type == 'local':
             db = sql_db.db_connect(template_operator_id.operator_db_name)
             with api.Environment.manage(), db.cursor() as cr:
@@ -77,24 +341,53 @@ class SAASOperator(models.Model):
                 # Some magic to force reloading registry in other workers
                 env.registry.registry_invalidated = True
                 env.registry.signal_changes()
-                template_operator_id.state = 'post_init'
-                self.with_delay().post_init(template_id, template_operator_id)
+        elif self.type == 'remote':
+            self._rpc_session(template_operator_id.operator_db_name).install_modules(modules)
+        else:
+            return
+        self.env['saas.db.phase'].record(template_operator_id.operator_db_id, [
+            ('install_modules', time.time() - start),
+        ], template_operator_id, description=', '.join(module_names))
+        if post_init:
+            template_operator_id.state = 'post_init'
+            self.with_delay(channel=self.job_channel(heavy=False)).post_init(template_id, template_operator_id)
+        else:
+            template_operator_id._on_template_ready()
 
     @job
+    @metrics.timed('saas_template_post_init')
     def post_init(self, template_id, template_operator_id):
+        if self.type not in ('local', 'remote'):
+            return
+        start = time.time()
+        self._execute_code(template_operator_id.operator_db_name, template_id.template_post_init,
+                           name='Template Initialization')
+        self.env['saas.db.phase'].record(template_operator_id.operator_db_id, [
+            ('post_init', time.time() - start),
+        ], template_operator_id)
+        template_operator_id._on_template_ready()
+
+    def _execute_code(self, db_name, code, name='Code Eval', params=None):
+        """Run initialization code in the database
+
+        :param params: dict of ir.config_parameter values to set before the code
+        """
+        self.ensure_one()
+        params = params or {}
         if self.type == 'local':
-            db = sql_db.db_connect(template_operator_id.operator_db_name)
-            registry(template_operator_id.operator_db_name).check_signaling()
+            db = sql_db.db_connect(db_name)
+            registry(db_name).check_signaling()
             with api.Environment.manage(), db.cursor() as cr:
                 env = api.Environment(cr, SUPERUSER_ID, {})
-                action = env['ir.actions.server'].create({
-                    'name': 'Local Code Eval',
-                    'state': 'code',
-                    'model_id': 1,
-                    'code': template_id.template_post_init
-                })
-                action.run()
-            template_operator_id.state = 'done'
+                for key, value in params.items():
+                    env['ir.config_parameter'].set_param(key, value)
+                run_code(env, code, name)
+        elif self.type == 'remote':
+            session = self._rpc_session(db_name)
+            for key, value in params.items():
+                session.execute_kw('ir.config_parameter', 'set_param', [key, value])
+            if (code or '').strip():
+                session.code_eval(code, name=name)
 
     def get_db_url(self, db):
         # TODO: use mako for url templating
@@ -106,6 +399,19 @@ class SAASOperator(models.Model):
         sequence = self.env['ir.sequence'].next_by_code('saas.db')
         return self.db_name_template.format(unique_id=sequence)
 
+    def generate_db_names(self, count):
+        """Same as generate_db_name, but reserves all numbers at once"""
+        self.ensure_one()
+        sequence = self.env['ir.sequence'].sudo().search([('code', '=', 'saas.db')], limit=1)
+        if sequence.implementation != 'standard' or sequence.use_date_range:
+            return [self.generate_db_name() for _i in range(count)]
+        self.env.cr.execute(
+            "SELECT nextval('ir_sequence_%03d') FROM generate_series(1, %%s)" % sequence.id, (count,))
+        return [
+            self.db_name_template.format(unique_id=sequence.get_next_char(number))
+            for number, in self.env.cr.fetchall()
+        ]
+
     def _get_mandatory_args(self, db):
         self.ensure_one()
         return {
@@ -113,52 +419,107 @@ class SAASOperator(models.Model):
             'build_id': db.id
         }
 
-    @staticmethod
-    def _get_mandatory_code():
-        master = "env['ir.config_parameter'].create([{{'key': 'auth_quick.master', 'value': '{master_url}'}}])\n"
-        build = "env['ir.config_parameter'].create([{{'key': 'auth_quick.build', 'value': '{build_id}'}}])\n"
-        return master + build
-
     def build_execute_kw(self, build, model, method, args=None, kwargs=None):
         args = args or []
         kwargs = kwargs or {}
         if self.type == 'local':
             return execute(build.name, SUPERUSER_ID, model, method, *args, **kwargs)
+        if self.type == 'remote':
+            return self._rpc_session(build.name).execute_kw(model, method, args, kwargs)
+
+    def _rpc_session(self, db_name):
+        """Session in a database of remote operator. Authentication is cached, and connections are kept alive"""
+        self.ensure_one()
+        return RPCSession(self.remote_url, db_name, self.remote_admin_login, self.remote_admin_password)
+
+    def _rpc_db(self, method, *args):
+        self.ensure_one()
+        return rpc_db(self.remote_url, self.remote_master_password, method, *args)
 
     @job
+    @metrics.timed('saas_build_post_init')
     def build_post_init(self, build, post_init_action, key_value_dict):
-        key_value_dict.update(self._get_mandatory_args(build))
-        code = self._get_mandatory_code() + post_init_action
-        action = {
-            'name': 'Build Code Eval',
-            'state': 'code',
-            'model_id': 1,
-            'code': string.Formatter().vformat(code, (), SafeDict(**key_value_dict))
+        with build._fail_on_error():
+            self._build_post_init(build, post_init_action, key_value_dict)
+
+    def _build_post_init(self, build, post_init_action, key_value_dict):
+        start = time.time()
+        mandatory_args = self._get_mandatory_args(build)
+        key_value_dict = dict(key_value_dict, **mandatory_args)
+        code = format_code(post_init_action or '', key_value_dict)
+        timings = [('post_init_format', time.time() - start)]
+        start = time.time()
+        params = {
+            'auth_quick.master': mandatory_args['master_url'],
+            'auth_quick.build': str(mandatory_args['build_id']),
         }
-        action_ids = self.build_execute_kw(build, 'ir.actions.server', 'create', [action])
-        self.build_execute_kw(build, 'ir.actions.server', 'run', [action_ids])
+        signing_key = self.env['auth_quick_master.token']._get_signing_key(params['auth_quick.build'])
+        if signing_key:
+            # allows the build to check its own signed tokens without requests to master
+            params['auth_quick.signing_key'] = signing_key
+        self._execute_code(build.name, code, name='Build Code Eval', params=params)
+        timings.append(('post_init', time.time() - start))
+        self.env['saas.db.phase'].record(build, timings)
+        build.state = 'done'
 
     @api.multi
     def write(self, vals):
+        res = super(SAASOperator, self).write(vals)
         if 'direct_url' in vals:
             self._update_direct_url(vals['direct_url'])
-        return super(SAASOperator, self).write(vals)
+        return res
 
     def _update_direct_url(self, url):
+        """Queue updating of Master URL in builds. Result of each build is saved in saas.log"""
+        for r in self:
+            builds = self.env['saas.db'].search([('operator_id', '=', r.id), ('type', 'in', ['build', 'spare'])])
+            for i in range(0, len(builds), DIRECT_URL_CHUNK_SIZE):
+                r.with_delay(channel=r.job_channel(heavy=False)).update_direct_url_chunk(
+                    builds[i:i + DIRECT_URL_CHUNK_SIZE], url)
+
+    @job
+    def update_direct_url_chunk(self, builds, url):
         self.ensure_one()
-        code = "env['ir.config_parameter'].set_param('auth_quick.master', '{}')\n".format(url)
-        builds = self.env['saas.db'].search([('operator_id', '=', self.id), ('type', '=', 'build')])
-        action = {
-            'name': 'Build Code Eval',
-            'state': 'code',
-            'model_id': 1,
-            'code': code,
-        }
-        for build in builds:
-            action_ids = self.build_execute_kw(build, 'ir.actions.server', 'create', [action])
-            self.build_execute_kw(build, 'ir.actions.server', 'run', [action_ids])
+        if self.direct_url != url:
+            return 'Master URL is changed again, newer jobs will update the builds'
+        builds = builds.exists()
+        if self.type == 'local':
+            def update(build_name):
+                _set_master_url(build_name, url)
+        elif self.type == 'remote':
+            # records are not thread-safe, so the values are read in advance
+            remote_args = (self.remote_url, self.remote_admin_login, self.remote_admin_password)
+
+            def update(build_name):
+                session = RPCSession(remote_args[0], build_name, *remote_args[1:])
+                session.execute_kw('ir.config_parameter', 'set_param', ['auth_quick.master', url])
+        else:
+            return
+
+        def safe_update(build_name):
+            try:
+                update(build_name)
+            except Exception as e:
+                _logger.warning('Master URL is not updated in %s', build_name, exc_info=True)
+                return str(e) or e.__class__.__name__
+
+        with ThreadPoolExecutor(max_workers=min(DIRECT_URL_WORKERS, len(builds) or 1)) as pool:
+            errors = list(pool.map(safe_update, builds.mapped('name')))
+        self.env['saas.log'].log_master_url_updated(builds, url, errors)
+        return 'Updated %s of %s builds' % (errors.count(None), len(builds))
 
 
-class SafeDict(defaultdict):
-    def __missing__(self, key):
-        return '{' + key + '}'
+def _set_master_url(db_name, url):
+    """Update auth_quick.master without loading registry of the build"""
+    with sql_db.db_connect(db_name).cursor() as cr:
+        cr.execute("""
+            UPDATE ir_config_parameter SET value = %s, write_date = now() at time zone 'UTC'
+            WHERE key = 'auth_quick.master'
+        """, (url,))
+        if not cr.rowcount:
+            cr.execute("""
+                INSERT INTO ir_config_parameter (key, value, create_uid, write_uid, create_date, write_date)
+                VALUES ('auth_quick.master', %s, %s, %s, now() at time zone 'UTC', now() at time zone 'UTC')
+            """, (url, SUPERUSER_ID, SUPERUSER_ID))
+        # make workers, which have registry of the build, clear the cached value
+        cr.execute("SELECT nextval('base_cache_signaling')")
@@ -2,6 +2,7 @@
 # Copyright 2019 Denis Mudarisov <https://it-projects.info/team/trojikman>
 # Copyright 2019 Anvar Kildebekov <https://it-projects.info/team/fedoranvar>
 # License AGPL-3.0 or later (https://www.gnu.org/licenses/agpl.html).
+from datetime import timedelta
 import random
 import string
 import logging
@@ -10,9 +11,22 @@ from slugify import slugify
 from odoo import models, fields, api, _
 from odoo.tools.safe_eval import test_python_expr
 from odoo.exceptions import ValidationError, UserError
+from odoo.addons.queue_job.job import job
 
 _logger = logging.getLogger(__name__)
 
+# states of template's deployment while its database is being prepared
+PREPARING_STATES = ['creating', 'installing_modules', 'post_init']
+# max number of builds being created at the same time by create_builds
+BULK_CONCURRENCY = 4
+# states of spare builds, which are still being prepared
+SPARE_PREPARING_STATES = ['duplicating', 'post_init']
+# spare builds, which are not ready after this number of hours, are considered stuck
+SPARE_PREPARING_TIMEOUT = 6
+# the pool is not refilled after this number of spare builds failed in a row,
+# e.g. when Build Initialization expects values, which spare builds don't get
+SPARE_MAX_FAILURES = 3
+
 DEFAULT_TEMPLATE_PYTHON_CODE = """# Available variables:
 #  - env: Odoo Environment on which the action is triggered
 #  - time, datetime, dateutil, timezone: useful Python libraries
@@ -53,6 +67,32 @@ class SAASTemplate(models.Model):
         default=DEFAULT_BUILD_PYTHON_CODE,
         help='Python code to be executed once build db is created from template')
     operator_ids = fields.One2many('saas.template.operator', 'template_id', string="Template's deployments")
+    parent_id = fields.Many2one(
+        'saas.template', 'Base Template', ondelete='restrict',
+        help='Template database is created as a copy of the base template database on the same operator, '
+             'then only extra modules are installed')
+    build_ttl = fields.Integer(
+        'Build Lifetime (hours)', default=0,
+        help='Builds are deleted once nobody logs in them for that number of hours. Set 0 to keep builds forever')
+    rebuild_priority = fields.Integer(
+        'Rebuild Priority', default=10, help='Templates with higher priority are rebuilt first')
+    operator_policy = fields.Selection([
+        ('random', 'Random'),
+        ('least_builds', 'Least Builds'),
+        ('least_jobs', 'Least Queued Jobs'),
+        ('weighted', 'Weighted Capacity'),
+        ('round_robin', 'Round Robin'),
+    ], 'Deployment Choice', default='random', required=True,
+        help='How deployment is chosen for a new build:\n'
+             '* Random\n'
+             '* Least Builds: operator with the smallest number of builds\n'
+             '* Least Queued Jobs: operator with the smallest number of queued heavy jobs\n'
+             '* Weighted Capacity: operator with the smallest number of builds per weight unit\n'
+             '* Round Robin: deployments are chosen in turn')
+    round_robin_sequence_id = fields.Many2one(
+        'ir.sequence', 'Round Robin Counter', readonly=True, copy=False,
+        help='Numbers builds of the template for Round Robin choice of deployments. '
+             'PostgreSQL sequence is used, so concurrent requests neither lock nor get the same number')
 
     @api.constrains('template_post_init')
     def _check_python_code(self):
@@ -61,14 +101,70 @@ class SAASTemplate(models.Model):
             if msg:
                 raise ValidationError(msg)
 
+    @api.constrains('parent_id')
+    def _check_parent_id(self):
+        if not self._check_recursion():
+            raise ValidationError(_('You cannot create recursive base templates.'))
+        for r in self:
+            if r.parent_id and r.parent_id.template_demo != r.template_demo:
+                raise ValidationError(_('Base template must have the same "Install demo data" value.'))
+
+    @api.model
+    def create(self, vals):
+        res = super(SAASTemplate, self).create(vals)
+        res._get_round_robin_sequence()
+        return res
+
+    def _get_round_robin_sequence(self):
+        """Sequences of templates created before the field was added are created on first use"""
+        self.ensure_one()
+        if not self.round_robin_sequence_id:
+            self.sudo().round_robin_sequence_id = self.env['ir.sequence'].sudo().create({
+                'name': 'Round Robin: %s' % (self.name or self.id),
+                'implementation': 'standard',
+            })
+        return self.round_robin_sequence_id.sudo()
+
     @api.multi
     def write(self, vals):
-        # if the following fields are updated, then we need to rebuild the template database
-        trigger_fields = ['template_demo', 'template_module_ids', 'template_post_init']
-        updated = any(val in vals for val in trigger_fields)
-        if updated:
-            self.operator_ids.write({'to_rebuild': True})
-        return super(SAASTemplate, self).write(vals)
+        if 'build_post_init' in vals:
+            # new code may fix spare builds
+            self.mapped('operator_ids').filtered('spare_failures').write({'spare_failures': 0})
+        # if the following fields are updated, then we need to rebuild the template database from scratch.
+        # Databases of derived templates are copies of this one, so they are rebuilt too
+        full_rebuild_fields = ['template_demo', 'template_post_init', 'parent_id']
+        if any(val in vals for val in full_rebuild_fields):
+            self._get_descendants().mapped('operator_ids').write({'to_rebuild': True, 'full_rebuild': True})
+            return super(SAASTemplate, self).write(vals)
+        if 'template_module_ids' not in vals:
+            return super(SAASTemplate, self).write(vals)
+
+        old_modules = {r: r.template_module_ids for r in self}
+        res = super(SAASTemplate, self).write(vals)
+        for r in self:
+            # new modules may be installed in the existing template database,
+            # but removed modules require a clean one
+            removed = old_modules[r] - r.template_module_ids
+            rebuild_vals = {'to_rebuild': True}
+            if removed:
+                rebuild_vals['full_rebuild'] = True
+            r._get_descendants().mapped('operator_ids').write(rebuild_vals)
+        return res
+
+    @api.multi
+    def _get_descendants(self):
+        """
+        :return: these templates and all templates based on them
+        """
+        return self.search([('id', 'child_of', self.ids)])
+
+    def _get_module_names(self):
+        """Modules of the template including ones of its base templates"""
+        self.ensure_one()
+        names = self.template_module_ids.mapped('name')
+        if self.parent_id:
+            names = self.parent_id._get_module_names() + names
+        return names
 
     @api.multi
     def action_create_build(self):
@@ -87,6 +183,23 @@ class SAASTemplate(models.Model):
         else:
             raise UserError(_('There are no ready template\'s deployments. Create new one or wait until it\'s done.'))
 
+    @api.multi
+    def action_create_builds(self):
+        self.ensure_one()
+        if any([rec.state == 'done' for rec in self.operator_ids]):
+            return {
+                'type': 'ir.actions.act_window',
+                'name': 'Create Builds',
+                'res_model': 'saas.template.create_builds',
+                'src_model': 'saas.template',
+                'view_type': 'form',
+                'view_mode': 'form',
+                'view_id': self.env.ref('saas.saas_template_create_builds').id,
+                'target': 'new',
+            }
+        else:
+            raise UserError(_('There are no ready template\'s deployments. Create new one or wait until it\'s done.'))
+
     @api.multi
     def refresh_page(self):
         # Empty-function for purpose of refreshing page
@@ -122,6 +235,23 @@ class SAASTemplateLine(models.Model):
     operator_db_id = fields.Many2one('saas.db', readonly=True)
     operator_db_state = fields.Selection(related='operator_db_id.state', string='Database operator state')
     to_rebuild = fields.Boolean(default=True)
+    full_rebuild = fields.Boolean(
+        default=True, help='Whether the template database has to be created from scratch on rebuild. '
+                           'Otherwise only missing modules are installed')
+    spare_min = fields.Integer(
+        'Minimum spare builds', default=0,
+        help='Refill the pool once fewer than this number of spare builds are left')
+    spare_max = fields.Integer(
+        'Maximum spare builds', default=0,
+        help='Number of builds that are prepared in advance. Set 0 to disable the pool')
+    spare_build_ids = fields.One2many(
+        'saas.db', 'template_operator_id', domain=[('type', '=', 'spare')], string='Spare builds', readonly=True)
+    spare_count = fields.Integer('Ready spare builds', compute='_compute_spare_count')
+    spare_failures = fields.Integer(
+        'Failed spare builds', readonly=True, copy=False,
+        help='Number of spare builds failed in a row. The pool is not refilled once there are %s of them, '
+             'until the template is rebuilt or its Build Initialization is changed' % SPARE_MAX_FAILURES)
+    phase_ids = fields.One2many('saas.db.phase', 'template_operator_id', 'Timeline', readonly=True)
     state = fields.Selection([
         ('draft', 'Draft'),
         ('creating', 'Database Creating'),
@@ -131,10 +261,22 @@ class SAASTemplateLine(models.Model):
 
     ], default='draft')
 
+    @api.depends('spare_build_ids.state')
+    def _compute_spare_count(self):
+        for r in self:
+            r.spare_count = len(r.spare_build_ids.filtered(lambda b: b.state == 'done'))
+
+    @api.constrains('spare_min', 'spare_max')
+    def _check_spare_limits(self):
+        for r in self:
+            if r.spare_min < 0 or r.spare_min > r.spare_max:
+                raise ValidationError(_('Minimum of spare builds must be between 0 and maximum of spare builds'))
+
     @api.model
     def unlink(self):
         for rec in self:
             rec.operator_db_id.unlink()
+            rec.spare_build_ids.unlink()
         return super(SAASTemplateLine, self).unlink()
 
     @api.model
@@ -143,28 +285,40 @@ class SAASTemplateLine(models.Model):
 
     @api.model
     def preparing_template_next(self):
+        """Start rebuilding templates in order of priority, while operators have free slots.
+        Called by cron and each time a template is ready"""
         template_operators = self.get_to_rebuild()
-        operators = template_operators.mapped('operator_id')
 
-        # filter out operators which already have template creating
-        def filter_free_operators(op):
+        # number of templates each operator may start now
+        free_slots = {}
+        for op in template_operators.mapped('operator_id'):
             states = op.template_operator_ids.mapped('state')
-            return all((s in ['draft', 'done'] for s in states))
-
-        operators = operators.filtered(filter_free_operators)
-        if not operators:
-            # it's not a time to start
-            return
-        for t_op in template_operators:
-            if t_op.operator_id not in operators:
+            free_slots[op] = op.template_concurrency - len([s for s in states if s in PREPARING_STATES])
+
+        for t_op in template_operators.sorted(key=lambda r: r._rebuild_sort_key()):
+            if free_slots[t_op.operator_id] <= 0:
+                continue
+            # the template may be already started by a nested call
+            if not t_op.to_rebuild or t_op.state in PREPARING_STATES:
+                continue
+            if not t_op._is_parent_ready():
                 continue
             t_op._prepare_template()
+            free_slots[t_op.operator_id] -= 1
 
-            # only one template per operator
-            operators -= t_op.operator_id
+    def _rebuild_sort_key(self):
+        """Templates with smaller keys are rebuilt first. Can be extended"""
+        self.ensure_one()
+        return -self.template_id.rebuild_priority, self.id
 
     def _prepare_template(self):
         for r in self:
+            # spare builds are copies of the old template database
+            r.spare_build_ids.unlink()
+            r.spare_failures = 0
+            if r._can_rebuild_incrementally():
+                r._update_template()
+                continue
             # delete db is there is one
             r.operator_db_id.drop_db()
             if not r.operator_db_id or r.operator_id != r.operator_db_id.operator_id:
@@ -178,17 +332,63 @@ class SAASTemplateLine(models.Model):
             r.write({
                 'state': 'creating',
             })
-            r.operator_db_id.with_delay().create_db(
-                None,
+            parent = r._get_parent_deployment()
+            r.operator_db_id.with_delay(channel=r.operator_id.job_channel()).create_db(
+                parent.operator_db_name or None,
                 r.template_id.template_demo,
                 callback_obj=r,
                 callback_method='_on_template_created')
 
+    def _get_parent_deployment(self):
+        """
+        :return: deployment of the base template on the same operator or empty recordset
+        """
+        self.ensure_one()
+        return self.template_id.parent_id.operator_ids.filtered(lambda r: r.operator_id == self.operator_id)[:1]
+
+    def _is_parent_ready(self):
+        """Whether the template database can be copied from the base one.
+        Templates without base template deployment on the operator are created from scratch"""
+        self.ensure_one()
+        parent = self._get_parent_deployment()
+        return not parent or parent.state == 'done' and not parent.to_rebuild
+
+    def _can_rebuild_incrementally(self):
+        self.ensure_one()
+        return not self.full_rebuild \
+            and self.state == 'done' \
+            and self.operator_db_id.state == 'done' \
+            and self.operator_id == self.operator_db_id.operator_id
+
+    def _update_template(self):
+        """Install missing modules in the existing template database"""
+        self.ensure_one()
+        self.write({
+            'to_rebuild': False,
+            'state': 'installing_modules',
+        })
+        self.operator_id.with_delay(channel=self.operator_id.job_channel()).install_modules(
+            self.template_id, self, post_init=False)
+
     def _on_template_created(self):
         self.ensure_one()
         self.to_rebuild = False
+        self.full_rebuild = False
         self.state = 'installing_modules'
-        self.operator_id.with_delay().install_modules(self.template_id, self)
+        self.operator_id.with_delay(channel=self.operator_id.job_channel()).install_modules(self.template_id, self)
+
+    def _on_template_ready(self):
+        self.ensure_one()
+        self.state = 'done'
+        # start next template without waiting for the cron
+        self.preparing_template_next()
+
+    @api.multi
+    def write(self, vals):
+        res = super(SAASTemplateLine, self).write(vals)
+        if vals.get('state') == 'done':
+            self.refill_spare_builds()
+        return res
 
     def prepare_name(self, db_name):
         self.ensure_one()
@@ -206,26 +406,216 @@ class SAASTemplateLine(models.Model):
         build = self.env['saas.db'].create({
             'name': db_name,
             'operator_id': self.operator_id.id,
+            'template_operator_id': self.id,
             'type': 'build',
+            'state': 'duplicating',
         })
 
         self.env['saas.log'].log_db_creating(build, self.operator_db_id)
         if with_delay:
-            build.with_delay().create_db(
+            # post init is queued only when database is copied
+            build.with_delay(channel=self.operator_id.job_channel()).create_db(
                 self.operator_db_name,
                 self.template_id.template_demo,
+                callback_obj=self,
+                callback_method='_on_build_created',
+                callback_args=[build, key_values],
             )
-            self.operator_id.with_delay().build_post_init(build, self.template_id.build_post_init, key_values)
         else:
             build.create_db(
                 self.operator_db_name,
                 self.template_id.template_demo,
             )
-            self.operator_id.build_post_init(build, self.template_id.build_post_init, key_values)
+            if build.state != 'failed':
+                self.operator_id.build_post_init(build, self.template_id.build_post_init, key_values)
 
         return build
 
+    @api.multi
+    def create_builds(self, builds, concurrency=BULK_CONCURRENCY):
+        """Create many builds at once. Deployment of each build is chosen by select_ready_operator,
+        so the policy of the template and max number of builds of operators are respected.
+        Builds, which don't fit to the operators, are not created.
+
+        :param builds: list of (db_name, key_values) pairs. db_name may be empty
+        :param concurrency: max number of builds being created at the same time on each operator
+        :return: saas.db recordset
+        """
+        ready = self.filtered(lambda r: r.state == 'done')
+        if not ready:
+            raise UserError(_('There are no ready template\'s deployments. Create new one or wait until it\'s done.'))
+
+        dbs = self.env['saas.db']
+        for db_name, _kv in builds:
+            # new builds are counted by the next selection
+            t_op = ready.select_ready_operator()
+            if not t_op:
+                break
+            dbs |= dbs.create({
+                'name': t_op.prepare_name(db_name) if db_name else t_op.operator_id.generate_db_name(),
+                'operator_id': t_op.operator_id.id,
+                'template_operator_id': t_op.id,
+                'type': 'build',
+                'state': 'duplicating',
+            })
+        if not dbs:
+            raise UserError(_('Operators of the template\'s deployments have reached their max number of builds.'))
+        if len(dbs) < len(builds):
+            _logger.warning('Only %s of %s builds are created: operators have reached their max number of builds',
+                            len(dbs), len(builds))
+        self.env['saas.log'].log_db_creating(dbs)
+
+        key_values_list = [kv or {} for _name, kv in builds[:len(dbs)]]
+        concurrency = max(concurrency, 1)
+        for operator in ready.mapped('operator_id'):
+            operator_dbs = dbs.filtered(lambda db: db.operator_id == operator)
+            operator_key_values = [kv for db, kv in zip(dbs, key_values_list) if db.operator_id == operator]
+            for lane in range(min(concurrency, len(operator_dbs))):
+                self.with_delay(channel=operator.job_channel()).create_builds_chain(
+                    operator_dbs[lane::concurrency], operator_key_values[lane::concurrency])
+        return dbs
+
+    @api.model
+    @job
+    def create_builds_chain(self, builds, key_values_list):
+        """Create builds one after another: each job creates the first build and queues the rest.
+        Failed build is marked as failed and doesn't stop the rest of the chain"""
+        build = builds[0]
+        t_op = build.template_operator_id
+        with build._fail_on_error():
+            build.create_db(
+                t_op.operator_db_name,
+                t_op.template_id.template_demo,
+            )
+            if build.state != 'failed':
+                t_op.operator_id.build_post_init(build, t_op.template_id.build_post_init, key_values_list[0])
+        if len(builds) > 1:
+            self.with_delay(channel=t_op.operator_id.job_channel()).create_builds_chain(builds[1:], key_values_list[1:])
+        if build.state == 'failed':
+            return 'Build %s is failed' % build.name
+
+    def _on_build_created(self, build, key_values):
+        self.ensure_one()
+        self.operator_id.with_delay(channel=self.operator_id.job_channel(heavy=False)).build_post_init(
+            build, self.template_id.build_post_init, key_values)
+
+    @api.multi
+    def refill_spare_builds(self):
+        """Top up the pools of spare builds, which have fallen below the minimum.
+        Failed and stuck spare builds are deleted and not counted"""
+        stuck_date = fields.Datetime.now() - timedelta(hours=SPARE_PREPARING_TIMEOUT)
+        for r in self:
+            if r.state != 'done' or not r.spare_max:
+                continue
+            dead = r.spare_build_ids.filtered(
+                lambda b: b.state != 'done' and (b.state not in SPARE_PREPARING_STATES or b.create_date < stuck_date))
+            failed = dead.filtered(lambda b: b.state == 'failed')
+            if failed:
+                r.spare_failures += len(failed)
+            elif r.spare_failures and r.spare_build_ids.filtered(lambda b: b.state == 'done'):
+                r.spare_failures = 0
+            if dead:
+                _logger.info('Delete failed or stuck spare builds: %s', ', '.join(dead.mapped('name')))
+                dead.unlink()
+            if r.spare_failures >= SPARE_MAX_FAILURES:
+                # otherwise the cron copies and drops databases forever
+                _logger.warning('Pool of spare builds of %s is not refilled: %s spare builds failed in a row',
+                                r.operator_db_name, r.spare_failures)
+                continue
+            # builds that are still being prepared are counted too
+            spare_count = len(r.spare_build_ids - dead)
+            if spare_count >= r.spare_min:
+                continue
+            for _i in range(r.spare_max - spare_count):
+                build = self.env['saas.db'].create({
+                    'name': r.operator_id.generate_db_name(),
+                    'operator_id': r.operator_id.id,
+                    'template_operator_id': r.id,
+                    'type': 'spare',
+                    'state': 'duplicating',
+                })
+                self.env['saas.log'].log_db_creating(build, r.operator_db_id)
+                r.with_delay(channel=r.operator_id.job_channel()).prepare_spare_build(build)
+
+    @job
+    def prepare_spare_build(self, build):
+        self.ensure_one()
+        # both steps are done in a single job, so the build is visible as ready
+        # only once it's post-initialized
+        with build._fail_on_error():
+            build.create_db(
+                self.operator_db_name,
+                self.template_id.template_demo,
+            )
+            if build.state != 'failed':
+                self.operator_id.build_post_init(build, self.template_id.build_post_init, {})
+
+    @api.multi
+    def claim_spare_build(self, key_values=None):
+        """Take a ready build from the pool of spare builds.
+
+        Spare builds are initialized without key values, so nothing is claimed
+        when key values are passed.
+
+        :return: claimed saas.db record or empty recordset
+        """
+        self.ensure_one()
+        build = self.env['saas.db']
+        if key_values or not self.spare_max:
+            return build
+        # SKIP LOCKED lets concurrent requests claim different builds without waiting for each other
+        self.env.cr.execute("""
+            SELECT id FROM saas_db
+            WHERE template_operator_id = %s AND type = 'spare' AND state = 'done'
+            ORDER BY id
+            LIMIT 1
+            FOR UPDATE SKIP LOCKED
+        """, (self.id,))
+        row = self.env.cr.fetchone()
+        if not row:
+            return build
+        build = build.browse(row[0])
+        build.write({
+            'type': 'build',
+            'claim_date': fields.Datetime.now(),
+        })
+        self.with_delay().refill_spare_builds()
+        return build
+
     @api.multi
     def random_ready_operator(self):
         ready_operators = self.filtered(lambda r: r.state == 'done')
         return random.choice(ready_operators)
+
+    @api.multi
+    def select_ready_operator(self, policy=None):
+        """Choose deployment for a new build according to the policy of the template.
+        Deployments of operators, which reached their max number of builds, are skipped.
+
+        :param policy: value of saas.template.operator_policy. Policy of the template is used by default
+        :return: saas.template.operator record or empty recordset
+        """
+        ready = self.filtered(lambda r: r.state == 'done')
+        if not ready:
+            return ready
+        policy = policy or ready[0].template_id.operator_policy or 'random'
+        operators = ready.mapped('operator_id')
+        build_counts = operators.get_build_counts()
+        ready = ready.filtered(
+            lambda r: not r.operator_id.max_builds or build_counts[r.operator_id.id] < r.operator_id.max_builds)
+        if not ready:
+            return ready
+
+        if policy == 'least_builds':
+            selected = min(ready, key=lambda r: build_counts[r.operator_id.id])
+        elif policy == 'least_jobs':
+            job_counts = operators.get_queued_job_counts()
+            selected = min(ready, key=lambda r: job_counts[r.operator_id.id])
+        elif policy == 'weighted':
+            selected = min(ready, key=lambda r: build_counts[r.operator_id.id] / max(r.operator_id.weight, 1))
+        elif policy == 'round_robin':
+            number = int(ready[0].template_id._get_round_robin_sequence()._next())
+            selected = ready.sorted('id')[(number - 1) % len(ready)]
+        else:
+            selected = random.choice(ready)
+        return selected
@@ -4,6 +4,7 @@ from odoo.service import db
 
 DB_TEMPLATE_1 = 'db_template_1'
 DB_TEMPLATE_2 = 'db_template_2'
+DB_TEMPLATE_3 = 'db_template_3'
 MODULE_TO_INSTALL = 'mail'
 TEMPLATE_TEST_SUBJECT = 'Dummy subject name to test that code is applied on template database'
 BUILD_TEST_SUBJECT = 'Dummy subject name to test that code is applied on build database'
@@ -1,16 +1,25 @@
 # Copyright 2018-2019 Denis Mudarisov <https://it-projects.info/team/trojikman>
 # License AGPL-3.0 or later (https://www.gnu.org/licenses/agpl.html).
-from .common_saas_test import Common, DB_TEMPLATE_1, DB_TEMPLATE_2, MODULE_TO_INSTALL, TEMPLATE_TEST_SUBJECT, \
-    BUILD_TEST_SUBJECT
+from .common_saas_test import Common, DB_TEMPLATE_1, DB_TEMPLATE_2, DB_TEMPLATE_3, MODULE_TO_INSTALL, \
+    TEMPLATE_TEST_SUBJECT, BUILD_TEST_SUBJECT
+
+from datetime import timedelta
+import os
+import tempfile
+from unittest import mock
 
 import odoo
-from odoo import SUPERUSER_ID
-from odoo.tests.common import tagged, SavepointCase
+from odoo import SUPERUSER_ID, fields
+from odoo.exceptions import UserError
+from odoo.tests.common import tagged, SavepointCase, HttpCase, HOST, PORT
 from odoo.service import db
+from odoo.addons.saas import metrics
 
 DB_INSTANCE_1 = 'db-instance-1'
 DB_INSTANCE_2 = 'db-instance-2'
+DB_INSTANCE_3 = 'db-instance-3'
 KEY_VALUES = {'mail_message': 'mail.message'}
+MODULE_TO_ADD = 'contacts'
 
 
 @tagged('post_install', 'at_install')
@@ -30,6 +39,13 @@ class TestSaas(SavepointCase, Common):
             env = odoo.api.Environment(cr, SUPERUSER_ID, {})
             return self.assertTrue(env[model_name].search(search_domain))
 
+    def count_records(self, db_name, model_name, search_domain):
+        db = odoo.sql_db.db_connect(db_name)
+        odoo.registry(db_name).check_signaling()
+        with odoo.api.Environment.manage(), db.cursor() as cr:
+            env = odoo.api.Environment(cr, SUPERUSER_ID, {})
+            return env[model_name].search_count(search_domain)
+
     def assert_no_error_in_db(self, dbname):
         # In order for the following tests to work correctly, you need to run odoo with parameter:
         # --log-db={db-name-where-tests-are-run}
@@ -81,9 +97,469 @@ class TestSaas(SavepointCase, Common):
         self.assert_record_is_created(DB_INSTANCE_1, 'ir.config_parameter', [('key', '=', 'auth_quick.master')])
         self.assert_record_is_created(DB_INSTANCE_1, 'ir.config_parameter', [('key', '=', 'auth_quick.build')])
         self.assert_record_is_created(DB_INSTANCE_1, 'mail.message', [('subject', '=', BUILD_TEST_SUBJECT)])
+        # duration of each phase is saved
+        build = self.env['saas.db'].search([('name', '=', DB_INSTANCE_1)])
+        self.assertEqual(build.phase_ids.mapped('name'), [
+            'drop_connections', 'database', 'registry', 'filestore', 'post_init_format', 'post_init',
+        ])
+        self.assertTrue({'database', 'install_modules', 'post_init'} <=
+                        set(self.saas_template_operator_1.phase_ids.mapped('name')))
+        # initialization code doesn't leave server actions
+        self.assertFalse(self.count_records(DB_INSTANCE_1, 'ir.actions.server', [('name', '=', 'Build Code Eval')]))
 
         self.saas_template_operator_2.create_db({}, DB_INSTANCE_2)
         self.assertIn(DB_INSTANCE_2, db.list_dbs())
         self.assert_no_error_in_db(DB_INSTANCE_2)
         self.assert_record_is_created(DB_INSTANCE_2, 'ir.config_parameter', [('key', '=', 'auth_quick.master')])
         self.assert_record_is_created(DB_INSTANCE_2, 'ir.config_parameter', [('key', '=', 'auth_quick.build')])
+
+        # Master URL is updated in builds by jobs
+        new_url = 'http://new-saas.127.0.0.1.nip.io:8069'
+        self.saas_operator_1.direct_url = new_url
+        self.assert_record_is_created(DB_INSTANCE_1, 'ir.config_parameter', [
+            ('key', '=', 'auth_quick.master'),
+            ('value', '=', new_url),
+        ])
+        self.assertTrue(self.env['saas.log'].search([
+            ('type', '=', 'master_url'),
+            ('db_id.name', '=', DB_INSTANCE_1),
+        ]))
+
+    def test_spare_builds(self):
+        self.drop_dbs([name for name in db.list_dbs() if name.startswith('test_db_')])
+        self.saas_template_operator_2.write({
+            'spare_min': 1,
+            'spare_max': 2,
+        })
+        self.env['saas.template.operator'].preparing_template_next()
+
+        # Pool is filled once the deployment is ready
+        spare_builds = self.saas_template_operator_2.spare_build_ids
+        self.assertEqual(len(spare_builds), 2)
+        for build in spare_builds:
+            self.assertEqual(build.state, 'done')
+            self.assertIn(build.name, db.list_dbs())
+            self.assert_record_is_created(build.name, 'ir.config_parameter', [('key', '=', 'auth_quick.build')])
+
+        # Builds with key values are never taken from the pool
+        self.assertFalse(self.saas_template_operator_2.claim_spare_build(KEY_VALUES))
+
+        build = self.saas_template_operator_2.claim_spare_build()
+        self.assertIn(build, spare_builds)
+        self.assertEqual(build.type, 'build')
+        self.assertTrue(build.claim_date)
+        # waiting for the first login is counted since the build is claimed, not since it's put to the pool
+        self.env.cr.execute(
+            "UPDATE saas_db SET create_date = create_date - interval '1 day' WHERE id = %s", (build.id,))
+        build.invalidate_cache()
+        self.env['auth_quick_master.token']._on_build_access(build.id)
+        first_login = build.phase_ids.filtered(lambda r: r.name == 'first_login')
+        self.assertLess(first_login.duration, 3600)
+        self.saas_template_operator_2.invalidate_cache()
+        self.assertNotIn(build, self.saas_template_operator_2.spare_build_ids)
+
+        # failed spare builds are deleted and not counted
+        failed = self.saas_template_operator_2.spare_build_ids
+        failed.state = 'failed'
+        self.saas_template_operator_2.refill_spare_builds()
+        self.assertFalse(failed.exists())
+        spare_builds = self.saas_template_operator_2.spare_build_ids
+        self.assertEqual(spare_builds.mapped('state'), ['done', 'done'])
+
+        # so are the ones, which are prepared for too long
+        stuck = spare_builds[0]
+        stuck.state = 'duplicating'
+        self.env.cr.execute(
+            "UPDATE saas_db SET create_date = create_date - interval '1 day' WHERE id = %s", (stuck.id,))
+        stuck.invalidate_cache()
+        self.saas_template_operator_2.refill_spare_builds()
+        self.assertFalse(stuck.exists())
+        self.assertEqual(self.saas_template_operator_2.spare_build_ids, spare_builds[1])
+
+        # the pool isn't refilled forever, when spare builds cannot be initialized
+        self.saas_template_2.build_post_init = "raise Warning('{key} is not passed')"
+        self.saas_template_operator_2.spare_build_ids.unlink()
+        for _i in range(3):
+            self.saas_template_operator_2.refill_spare_builds()
+            self.saas_template_operator_2.invalidate_cache()
+        self.assertEqual(self.saas_template_operator_2.spare_failures, 4)
+        self.assertFalse(self.saas_template_operator_2.spare_build_ids)
+        self.saas_template_2.build_post_init = 'pass'
+        self.assertEqual(self.saas_template_operator_2.spare_failures, 0)
+
+    def test_create_builds(self):
+        self.drop_dbs([name for name in db.list_dbs() if name.startswith('test_db_')] + [DB_INSTANCE_3])
+        self.env['saas.template.operator'].preparing_template_next()
+
+        builds = self.saas_template_operator_2.create_builds([
+            (None, {}),
+            (None, {}),
+            (DB_INSTANCE_3, {}),
+        ], concurrency=2)
+        self.assertEqual(len(builds), 3)
+        self.assertEqual(builds[2].name, DB_INSTANCE_3)
+        for build in builds:
+            self.assertEqual(build.state, 'done')
+            self.assertIn(build.name, db.list_dbs())
+            self.assert_record_is_created(build.name, 'ir.config_parameter', [('key', '=', 'auth_quick.build')])
+        self.assertEqual(self.env['saas.log'].search_count([('db_id', 'in', builds.ids), ('type', '=', 'creation')]), 3)
+
+        # failed build doesn't stop the rest of the chain
+        self.saas_template_2.build_post_init = "if '{fail}' == 'yes':\n    raise Warning('Build is broken')"
+        builds = self.saas_template_operator_2.create_builds([
+            (None, {'fail': 'yes'}),
+            (None, {}),
+        ], concurrency=1)
+        self.assertEqual(builds.mapped('state'), ['failed', 'done'])
+        self.assertTrue(self.env['saas.log'].search([('db_id', '=', builds[0].id), ('type', '=', 'failed')]))
+
+        # builds over max number of builds of the operator are not created
+        self.saas_template_2.build_post_init = 'pass'
+        self.saas_operator_2.max_builds = self.saas_operator_2.get_build_counts()[self.saas_operator_2.id] + 1
+        builds = self.saas_template_operator_2.create_builds([
+            (None, {}),
+            (None, {}),
+        ])
+        self.assertEqual(builds.mapped('state'), ['done'])
+        with self.assertRaises(UserError):
+            self.saas_template_operator_2.create_builds([(None, {})])
+
+    def test_rebuild_priority(self):
+        operator = self.env['saas.operator'].create({
+            'type': 'local',
+            'db_url_template': 'http://{db_name}.{db_id}.127.0.0.1.nip.io:8069',
+            'db_name_template': 'test_db_{unique_id}',
+            'direct_url': 'http://saas.127.0.0.1.nip.io:8069',
+            'template_concurrency': 2,
+        })
+        template_operators = self.env['saas.template.operator'].create([{
+            'template_id': self.env['saas.template'].create({'rebuild_priority': priority}).id,
+            'operator_id': operator.id,
+            'operator_db_name': 'template_priority_%s' % i,
+        } for i, priority in enumerate([1, 20, 5, 20])])
+        TemplateOperator = type(self.env['saas.template.operator'])
+        started = []
+
+        def prepare_template(records):
+            started.extend(records.filtered(lambda r: r.operator_id == operator).ids)
+            records.write({'state': 'creating'})
+
+        with mock.patch.object(TemplateOperator, '_prepare_template', autospec=True, side_effect=prepare_template):
+            # only free slots are used, templates with higher priority go first
+            self.env['saas.template.operator'].preparing_template_next()
+            self.assertEqual(started, template_operators[1:4:2].ids)
+            # slots are taken by the templates being prepared
+            self.env['saas.template.operator'].preparing_template_next()
+            self.assertEqual(len(started), 2)
+
+            operator.template_concurrency = 3
+            self.env['saas.template.operator'].preparing_template_next()
+            self.assertEqual(started, template_operators[1:4:2].ids + template_operators[2].ids)
+
+            template_operators[1].write({'state': 'done', 'to_rebuild': False})
+            self.env['saas.template.operator'].preparing_template_next()
+            self.assertEqual(started[-1], template_operators[0].id)
+
+    def test_job_channels(self):
+        channel = self.saas_operator_1.job_channel_id
+        self.assertEqual(channel.complete_name, 'root.saas.operator_%s' % self.saas_operator_1.id)
+        subchannels = self.env['queue.job.channel'].search([('parent_id', '=', channel.id)])
+        self.assertEqual(sorted(subchannels.mapped('name')), ['heavy', 'light'])
+        self.assertEqual(self.saas_operator_1.job_channel(), channel.complete_name + '.heavy')
+        self.assertEqual(self.saas_operator_1.job_channel(heavy=False), channel.complete_name + '.light')
+
+    def test_select_ready_operator(self):
+        template_operator_3 = self.env['saas.template.operator'].create({
+            'template_id': self.saas_template_1.id,
+            'operator_id': self.saas_operator_2.id,
+            'operator_db_name': DB_TEMPLATE_3,
+        })
+        deployments = self.saas_template_operator_1 | template_operator_3
+        self.assertFalse(deployments.select_ready_operator())
+
+        deployments.write({'state': 'done'})
+        self.env['saas.db'].create([{
+            'name': 'db_busy_%s' % i,
+            'operator_id': self.saas_operator_1.id,
+            'type': 'build',
+            'state': 'done',
+        } for i in range(2)])
+        self.assertEqual(deployments.select_ready_operator('least_builds'), template_operator_3)
+
+        self.env['saas.db'].create({
+            'name': 'db_busy_3',
+            'operator_id': self.saas_operator_2.id,
+            'type': 'build',
+            'state': 'done',
+        })
+        self.saas_operator_1.weight = 10
+        self.assertEqual(deployments.select_ready_operator('weighted'), self.saas_template_operator_1)
+
+        first = deployments.select_ready_operator('round_robin')
+        second = deployments.select_ready_operator('round_robin')
+        self.assertEqual(first | second, deployments)
+        # counter doesn't depend on time, so fast requests are distributed too
+        self.assertEqual(deployments.select_ready_operator('round_robin'), first)
+        self.assertEqual(deployments.select_ready_operator('round_robin'), second)
+
+        self.saas_operator_2.max_builds = 1
+        self.assertEqual(deployments.select_ready_operator('least_builds'), self.saas_template_operator_1)
+
+    def test_incremental_rebuild(self):
+        self.drop_dbs()
+        self.env['saas.template.operator'].preparing_template_next()
+        self.assertFalse(self.saas_template_operator_2.full_rebuild)
+
+        # adding a module doesn't recreate template database
+        self.saas_template_2.write({
+            'template_module_ids': [(0, 0, {'name': MODULE_TO_ADD})],
+        })
+        self.assertTrue(self.saas_template_operator_2.to_rebuild)
+        self.assertFalse(self.saas_template_operator_2.full_rebuild)
+        self.env['saas.template.operator'].preparing_template_next()
+        self.assertEqual(self.saas_template_operator_2.state, 'done')
+        self.assert_modules_is_installed(DB_TEMPLATE_2, MODULE_TO_ADD)
+        # Template Initialization is not executed again
+        message_count = self.count_records(DB_TEMPLATE_2, 'mail.message', [('subject', '=', TEMPLATE_TEST_SUBJECT)])
+        self.assertEqual(message_count, 1)
+
+        # changed initialization code requires a new database
+        self.saas_template_2.write({
+            'template_post_init': 'pass',
+        })
+        self.assertTrue(self.saas_template_operator_2.full_rebuild)
+
+    def test_base_template(self):
+        self.drop_dbs([DB_TEMPLATE_3])
+        template_3 = self.env['saas.template'].create({
+            'parent_id': self.saas_template_2.id,
+            'template_module_ids': [(0, 0, {'name': MODULE_TO_ADD})],
+        })
+        template_operator_3 = self.env['saas.template.operator'].create({
+            'template_id': template_3.id,
+            'operator_id': self.saas_operator_2.id,
+            'operator_db_name': DB_TEMPLATE_3,
+        })
+        # derived template waits for the base one
+        self.assertFalse(template_operator_3._is_parent_ready())
+        self.env['saas.template.operator'].preparing_template_next()
+        self.assertEqual(template_operator_3.state, 'done')
+
+        self.assertIn(DB_TEMPLATE_3, db.list_dbs())
+        self.assert_modules_is_installed(DB_TEMPLATE_3, MODULE_TO_INSTALL)
+        self.assert_modules_is_installed(DB_TEMPLATE_3, MODULE_TO_ADD)
+        # data of the base template is copied
+        self.assert_record_is_created(DB_TEMPLATE_3, 'mail.message', [('subject', '=', TEMPLATE_TEST_SUBJECT)])
+
+        self.saas_template_2.write({
+            'template_post_init': 'pass',
+        })
+        self.assertTrue(template_operator_3.to_rebuild)
+        self.assertTrue(template_operator_3.full_rebuild)
+
+    def test_expired_builds(self):
+        self.saas_template_1.build_ttl = 24
+        builds = self.env['saas.db'].create([{
+            'name': 'db_expiring_%s' % i,
+            'operator_id': self.saas_operator_1.id,
+            'template_operator_id': self.saas_template_operator_1.id,
+            'type': 'build',
+            'state': state,
+            'last_access': last_access,
+        } for i, (state, last_access) in enumerate([
+            ('done', fields.Datetime.now() - timedelta(hours=25)),
+            ('done', fields.Datetime.now() - timedelta(hours=1)),
+            # dropping job of these builds is failed
+            ('dropping', fields.Datetime.now() - timedelta(hours=25)),
+            ('dropping', fields.Datetime.now() - timedelta(hours=25)),
+        ])])
+        self.env.cr.execute(
+            "UPDATE saas_db SET write_date = write_date - interval '1 day' WHERE id = %s", (builds[2].id,))
+        builds.invalidate_cache()
+        expired = self.env['saas.db'].reap_expired_builds(batch_size=1)
+        self.assertEqual(expired, builds[0] | builds[2])
+        self.assertFalse(builds[0].exists())
+        self.assertTrue(builds[1].exists())
+        self.assertFalse(builds[2].exists())
+        # builds, which are queued recently, are not queued twice
+        self.assertTrue(builds[3].exists())
+
+        # builds without template get lifetime from system parameter
+        build = self.env['saas.db'].create({
+            'name': 'db_expiring_without_template',
+            'operator_id': self.saas_operator_1.id,
+            'type': 'build',
+            'state': 'done',
+            'last_access': fields.Datetime.now() - timedelta(hours=25),
+        })
+        self.assertFalse(self.env['saas.db'].reap_expired_builds())
+        self.env['ir.config_parameter'].set_param('saas.build_ttl', '24')
+        self.assertEqual(self.env['saas.db'].reap_expired_builds(), build)
+
+    def test_copy_filestore(self):
+        operator = self.saas_operator_1
+        with tempfile.TemporaryDirectory() as tmp:
+            from_fs = os.path.join(tmp, 'template')
+            os.makedirs(os.path.join(from_fs, 'ab'))
+            from_file = os.path.join(from_fs, 'ab', 'abcdef')
+            with open(from_file, 'w') as f:
+                f.write('content')
+
+            def copy(clone_strategy, name, **kwargs):
+                operator.clone_strategy = clone_strategy
+                to_fs = os.path.join(tmp, name)
+                operator._copy_filestore(from_fs, to_fs, **kwargs)
+                return os.path.join(to_fs, 'ab', 'abcdef')
+
+            for strategy in ['copy', 'reflink']:
+                to_file = copy(strategy, strategy)
+                with open(to_file) as f:
+                    self.assertEqual(f.read(), 'content')
+                self.assertNotEqual(os.stat(to_file).st_ino, os.stat(from_file).st_ino)
+
+            to_file = copy('hardlink', 'hardlink')
+            self.assertEqual(os.stat(to_file).st_ino, os.stat(from_file).st_ino)
+
+            self.assertFalse(os.path.exists(copy('no_filestore', 'no_filestore')))
+            # strategy of the operator can be overridden, e.g. for templates
+            to_file = copy('no_filestore', 'template_copy', strategy='hardlink')
+            self.assertEqual(os.stat(to_file).st_ino, os.stat(from_file).st_ino)
+
+            # hard links are not possible between different filesystems
+            with mock.patch('os.link', side_effect=OSError('Invalid cross-device link')):
+                to_file = copy('hardlink', 'fallback')
+            with open(to_file) as f:
+                self.assertEqual(f.read(), 'content')
+            self.assertNotEqual(os.stat(to_file).st_ino, os.stat(from_file).st_ino)
+
+    def test_remote_operator(self):
+        self.drop_dbs([DB_INSTANCE_3])
+        self.env['saas.template.operator'].preparing_template_next()
+        # this server plays the role of the remote one
+        remote_operator = self.env['saas.operator'].create({
+            'type': 'remote',
+            'db_url_template': 'http://{db_name}.{db_id}.127.0.0.1.nip.io:8069',
+            'db_name_template': 'test_db_{unique_id}',
+            'direct_url': 'http://saas.127.0.0.1.nip.io:8069',
+            'remote_url': 'http://127.0.0.1:%s' % odoo.tools.config['http_port'],
+            'remote_master_password': odoo.tools.config['admin_passwd'],
+        })
+        build = self.env['saas.db'].create({
+            'name': DB_INSTANCE_3,
+            'operator_id': remote_operator.id,
+            'type': 'build',
+        })
+        remote_operator._create_db(DB_TEMPLATE_2, DB_INSTANCE_3, False, 'en_US')
+        self.assertIn(DB_INSTANCE_3, db.list_dbs())
+        partner_count = remote_operator.build_execute_kw(build, 'res.partner', 'search_count', [[]])
+        self.assertEqual(partner_count, self.count_records(DB_INSTANCE_3, 'res.partner', []))
+        # Odoo has no system.multicall, so calls are made one by one in the same session
+        session = remote_operator._rpc_session(DB_INSTANCE_3)
+        self.assertEqual(session.multicall([
+            ('res.partner', 'search_count', [[]]),
+            ('res.users', 'search_count', [[('login', '=', 'admin')]]),
+        ]), [partner_count, 1])
+
+        build.drop_db()
+        self.assertNotIn(DB_INSTANCE_3, db.list_dbs())
+
+    def test_log_rollup(self):
+        build = self.env['saas.db'].create({
+            'name': 'db_with_old_logs',
+            'operator_id': self.saas_operator_1.id,
+            'type': 'build',
+        })
+        self.env['saas.log'].log_db_dropped(build | build)
+        logs = self.env['saas.log'].search([('db_id', '=', build.id)])
+        self.assertEqual(len(logs), 2)
+        self.env.cr.execute("UPDATE saas_log SET create_date = create_date - interval '1 year' WHERE id IN %s",
+                            (tuple(logs.ids),))
+        self.assertEqual(self.env['saas.log'].rollup_old_logs(), 2)
+        self.assertFalse(logs.exists())
+        daily = self.env['saas.log.daily'].search([('db_id', '=', build.id)])
+        self.assertEqual(daily.mapped('type'), ['dropped'])
+        self.assertEqual(daily.count, 2)
+
+        # events without database are summed up with the existing statistics
+        old_date = '2001-02-03'
+        for _i in range(2):
+            log = self.env['saas.log'].create({'type': 'dropped'})
+            self.env.cr.execute("UPDATE saas_log SET create_date = %s WHERE id = %s", (old_date + ' 10:00:00', log.id))
+            self.env['saas.log'].rollup_old_logs()
+        self.env.cr.execute("UPDATE saas_log_daily SET date = %s WHERE id = %s", (old_date, daily.id))
+        build.unlink()
+        daily = self.env['saas.log.daily'].search([('date', '=', old_date), ('type', '=', 'dropped')])
+        self.assertFalse(daily.db_id)
+        self.assertEqual(daily.count, 4)
+
+    def test_log_buffer(self):
+        build = self.env['saas.db'].create({
+            'name': 'db_with_buffered_logs',
+            'operator_id': self.saas_operator_1.id,
+            'type': 'build',
+        })
+        log = self.env['saas.log'].with_context(saas_log_buffered=True)
+        log.log_db_created(build)
+        log.log_db_dropped(build)
+        log.log_db_dropped(build)
+        # events of rolled back savepoints are discarded
+        with self.assertRaises(ValueError):
+            with log._savepoint():
+                log.log_db_dropped(build)
+                raise ValueError()
+        rows = self.env.cr._saas_log_buffer
+        self.env.cr._saas_log_buffer = None
+        self.assertEqual(len(rows), 3)
+        self.assertFalse(self.env['saas.log'].search([('db_id', '=', build.id)]))
+
+        # broken event doesn't prevent saving the other ones
+        rows[1]['user_id'] = -1
+        self.registry.enter_test_mode(self.env.cr)
+        try:
+            log._flush_log_buffer(self.env.cr.dbname, rows)
+        finally:
+            self.registry.leave_test_mode()
+        self.assertEqual(sorted(self.env['saas.log'].search([('db_id', '=', build.id)]).mapped('type')),
+                         ['created', 'dropped'])
+
+    def test_metrics(self):
+        self.drop_dbs()
+        self.env['saas.template.operator'].preparing_template_next()
+        text = metrics.render(self.env['saas.operator'].get_metrics_gauges())
+        self.assertIn('# TYPE saas_db_create_seconds histogram', text)
+        self.assertIn('saas_install_modules_total{status="ok"', text)
+        self.assertIn('saas_template_deployments{operator="%s",state="done"} 1' % self.saas_operator_1.id, text)
+
+
+@tagged('post_install', 'at_install')
+class TestSaasController(HttpCase, Common):
+
+    def setUp(self):
+        super(TestSaasController, self).setUp()
+        self.setup_saas_env()
+        self.build = self.env['saas.db'].create({
+            'name': 'db_auth_to_build',
+            'operator_id': self.saas_operator_1.id,
+            'type': 'build',
+            'state': 'done',
+        })
+        self.authenticate('admin', 'admin')
+
+    def auth_to_build(self):
+        url = 'http://%s:%s/saas/auth-to-build/%s' % (HOST, PORT, self.build.id)
+        # the url contains token, which is not checked here
+        return self.opener.get(url, timeout=10, allow_redirects=False)
+
+    def test_auth_to_build(self):
+        response = self.auth_to_build()
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(self.build.get_url(), response.text)
+        self.assertEqual(response.headers['Cache-Control'], 'no-store')
+        self.assertEqual(response.headers['Referrer-Policy'], 'no-referrer')
+
+        self.env['ir.config_parameter'].set_param('auth_quick_master.direct_redirect', '1')
+        response = self.auth_to_build()
+        self.assertEqual(response.status_code, 302)
+        self.assertTrue(response.headers['Location'].startswith(self.build.get_url() + '/auth_quick/login'))
+        self.assertEqual(response.headers['Cache-Control'], 'no-store')
+        self.assertEqual(response.headers['Referrer-Policy'], 'no-referrer')
@@ -1,2 +1,3 @@
 # License AGPL-3.0 or later (https://www.gnu.org/licenses/agpl.html).
-from . import saas_template_create_build
\ No newline at end of file
+from . import saas_template_create_build
+from . import saas_template_create_builds
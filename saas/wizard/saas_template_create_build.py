@@ -13,7 +13,8 @@ class CreateBuildByTemplate(models.TransientModel):
     template_operator_id = fields.Many2one(
         'saas.template.operator', 'Template\'s Deployment', required=True, ondelete='cascade'
     )
-    random = fields.Boolean(string='Use random operator')
+    random = fields.Boolean(string='Choose operator automatically',
+                            help='Deployment is chosen according to the Deployment Choice of the template')
     build_post_init_ids = fields.One2many('build.post_init.line', 'build_creation_id',
                                           string="Build Initialization Values",
                                           help="These values will be used on execution "
@@ -53,8 +54,7 @@ class CreateBuildByTemplate(models.TransientModel):
     @api.onchange('random')
     def change_operator(self):
         if self.random:
-            random_operator = self.template_id.operator_ids.random_ready_operator()
-            self.template_operator_id = random_operator
+            self.template_operator_id = self.template_id.operator_ids.select_ready_operator()
 
 
 class BuildPostInit(models.TransientModel):
@@ -0,0 +1,57 @@
+# License AGPL-3.0 or later (https://www.gnu.org/licenses/agpl.html).
+from odoo import api, models, fields
+
+from ..models.saas_template import BULK_CONCURRENCY
+
+
+class CreateBuildsByTemplate(models.TransientModel):
+    _name = 'saas.template.create_builds'
+    _description = 'Wizard to create many builds by template'
+
+    def _default_template_id(self):
+        return self.env.context.get('active_id')
+
+    def _default_template_operator_ids(self):
+        template = self.env['saas.template'].browse(self._default_template_id())
+        return template.operator_ids.filtered(lambda r: r.state == 'done')
+
+    template_id = fields.Many2one('saas.template', default=_default_template_id)
+    template_operator_ids = fields.Many2many(
+        'saas.template.operator', string='Template\'s Deployments', required=True,
+        default=_default_template_operator_ids,
+        help='Builds are distributed across these deployments by Deployment Choice of the template')
+    build_count = fields.Integer('Number of builds', required=True, default=10)
+    build_name_prefix = fields.Char(
+        'Build name prefix', help='Builds get names like prefix-1, prefix-2, etc. '
+                                  'Keep empty to generate names by operator\'s settings')
+    concurrency = fields.Integer(
+        'Concurrency', required=True, default=BULK_CONCURRENCY,
+        help='Max number of builds being created at the same time on each operator')
+    build_post_init_ids = fields.One2many('build.post_init.line', 'bulk_creation_id',
+                                          string="Build Initialization Values",
+                                          help="These values will be used on execution "
+                                               "template's Build Initialization code for every build")
+
+    @api.multi
+    def create_builds(self):
+        self.ensure_one()
+        key_value_dict = self.env['saas.template.create_build']._convert_to_dict(self.build_post_init_ids)
+        builds = [
+            (self.build_name_prefix and '%s-%s' % (self.build_name_prefix, i + 1), dict(key_value_dict))
+            for i in range(self.build_count)
+        ]
+        dbs = self.template_operator_ids.sudo().create_builds(builds, self.concurrency)
+        return {
+            'type': 'ir.actions.act_window',
+            'name': 'SaaS DB',
+            'res_model': 'saas.db',
+            'domain': [('id', 'in', dbs.ids)],
+            'view_mode': 'tree,form',
+            'target': 'main',
+        }
+
+
+class BuildPostInit(models.TransientModel):
+    _inherit = 'build.post_init.line'
+
+    bulk_creation_id = fields.Many2one('saas.template.create_builds', readonly=True)
@@ -2,47 +2,165 @@
 # License LGPL-3.0 or later (https://www.gnu.org/licenses/lgpl.html).
 # Based on https://github.com/it-projects-llc/odoo-saas-tools/blob/11.0/saas.py
 import logging
+import threading
 import xmlrpc.client
 
 _logger = logging.getLogger(__name__)
 
+# seconds to wait for remote server, e.g. database duplication may take long
+TIMEOUT = 600
 
-def rpc_auth(url, db_name, admin_username='admin', admin_password='admin'):
-    # Authenticate
-    common = xmlrpc.client.ServerProxy('{}/xmlrpc/2/common'.format(url))
-    admin_uid = common.authenticate(db_name, admin_username, admin_password, {})
-    models = xmlrpc.client.ServerProxy('{}/xmlrpc/2/object'.format(url))
-    if not admin_uid:
-        _logger.debug('Authentication failed %s', ((url, db_name, admin_username, admin_password),))
-        raise Exception('Authentication to %s is failed' % url)
-    return db_name, models, admin_uid, admin_password
-
-
-def rpc_execute_kw(auth, model, method, rpc_args=None, rpc_kwargs=None):
-    rpc_args = rpc_args or []
-    rpc_kwargs = rpc_kwargs or {}
-    db_name, models, admin_uid, admin_password = auth
-    _logger.debug('RPC Execute: env["%s"].%s(*%s, **%s)', model, method, rpc_args, rpc_kwargs)
-    return models.execute_kw(db_name, admin_uid, admin_password,
-                             model, method, rpc_args, rpc_kwargs)
-
-
-def rpc_install_modules(auth, domain):
-    domain = [('state', '=', 'uninstalled')] + domain
-    module_ids = rpc_execute_kw(auth, 'ir.module.module', 'search', [domain])
-    rpc_execute_kw(auth, 'ir.module.module', 'button_immediate_install', [module_ids])
-
-
-def rpc_code_eval(auth, code, name='RPC Code Eval'):
-    # it's not really important which model to use
-    domain = [('model', '=', 'res.users')]
-    model_id = rpc_execute_kw(auth, 'ir.model', 'search', [domain])[0]
-
-    vals = {
-        'name': name,
-        'state': 'code',
-        'code': code,
-        'model_id': model_id,
-    }
-    action_ids = rpc_execute_kw(auth, 'ir.actions.server', 'create', [vals])
-    rpc_execute_kw(auth, 'ir.actions.server', 'run', [action_ids])
+# proxies are not thread-safe, so each thread keeps its own ones
+_local = threading.local()
+# (url, db_name, username, password) -> uid
+_uid_cache = {}
+# url -> whether server supports system.multicall
+_multicall_support = {}
+
+
+class KeepAliveTransport(xmlrpc.client.Transport):
+    """HTTP/1.1 transport with timeout. The connection is kept open between requests
+    (and reopened by the base class once the server closes it)"""
+
+    def __init__(self, timeout=TIMEOUT, **kwargs):
+        super(KeepAliveTransport, self).__init__(**kwargs)
+        self.timeout = timeout
+
+    def make_connection(self, host):
+        conn = super(KeepAliveTransport, self).make_connection(host)
+        conn.timeout = self.timeout
+        return conn
+
+
+class SafeKeepAliveTransport(KeepAliveTransport, xmlrpc.client.SafeTransport):
+    pass
+
+
+def _transport(url):
+    """Transport of the current thread, which is shared by all endpoints of the server,
+    i.e. common, object and db services use the same connection"""
+    transports = _local.__dict__.setdefault('transports', {})
+    scheme, rest = url.split('://', 1)
+    key = (scheme, rest.split('/', 1)[0])
+    if key not in transports:
+        cls = SafeKeepAliveTransport if scheme == 'https' else KeepAliveTransport
+        transports[key] = cls(use_datetime=True)
+    return transports[key]
+
+
+def server_proxy(url):
+    """ServerProxy reused by the current thread, so its HTTP/1.1 connection is kept alive between calls"""
+    proxies = _local.__dict__.setdefault('proxies', {})
+    if url not in proxies:
+        proxies[url] = xmlrpc.client.ServerProxy(url, transport=_transport(url), allow_none=True)
+    return proxies[url]
+
+
+class RPCSession(object):
+    """Authenticated connection to a database of remote server.
+
+    Authentication is made on first call and cached for all sessions of the same database
+    until :func:`rpc_forget` is called. ::
+
+        session = RPCSession('http://odoo.example.com', 'db1', 'admin', 'admin')
+        session.execute_kw('res.partner', 'search_count', [[]])
+        session.multicall([
+            ('res.partner', 'search_count', [[]]),
+            ('res.users', 'search_count', [[]]),
+        ])
+    """
+
+    def __init__(self, url, db_name, login='admin', password='admin'):
+        self.url = url
+        self.db_name = db_name
+        self.login = login
+        self.password = password
+        self._model_ids = {}
+
+    @property
+    def models(self):
+        return server_proxy('{}/xmlrpc/2/object'.format(self.url))
+
+    @property
+    def uid(self):
+        key = (self.url, self.db_name, self.login, self.password)
+        uid = _uid_cache.get(key)
+        if not uid:
+            common = server_proxy('{}/xmlrpc/2/common'.format(self.url))
+            uid = common.authenticate(self.db_name, self.login, self.password, {})
+            if not uid:
+                _logger.debug('Authentication failed %s', ((self.url, self.db_name, self.login, self.password),))
+                raise Exception('Authentication to %s is failed' % self.url)
+            _uid_cache[key] = uid
+        return uid
+
+    def execute_kw(self, model, method, rpc_args=None, rpc_kwargs=None):
+        rpc_args = rpc_args or []
+        rpc_kwargs = rpc_kwargs or {}
+        _logger.debug('RPC Execute: env["%s"].%s(*%s, **%s)', model, method, rpc_args, rpc_kwargs)
+        return self.models.execute_kw(self.db_name, self.uid, self.password,
+                                      model, method, rpc_args, rpc_kwargs)
+
+    def multicall(self, calls):
+        """Execute independent calls in a single request when server supports ``system.multicall``
+        (Odoo doesn't provide it out of the box), otherwise one by one over the same connection.
+
+        :param calls: list of (model, method, args[, kwargs])
+        :return: list of results
+        """
+        calls = [(c[0], c[1], c[2] if len(c) > 2 else [], c[3] if len(c) > 3 else {}) for c in calls]
+        if len(calls) > 1 and _multicall_support.get(self.url, True):
+            uid = self.uid
+            batch = xmlrpc.client.MultiCall(self.models)
+            for model, method, rpc_args, rpc_kwargs in calls:
+                batch.execute_kw(self.db_name, uid, self.password, model, method, rpc_args, rpc_kwargs)
+            try:
+                results = batch()
+            except xmlrpc.client.Fault:
+                if _multicall_support.get(self.url):
+                    raise
+                # nothing is executed, when method is unknown
+                _logger.debug('system.multicall is not supported by %s', self.url)
+                _multicall_support[self.url] = False
+            else:
+                _multicall_support[self.url] = True
+                # faults of individual calls are raised here
+                return list(results)
+        return [self.execute_kw(*c) for c in calls]
+
+    def model_id(self, model):
+        if model not in self._model_ids:
+            self._model_ids[model] = self.execute_kw('ir.model', 'search', [[('model', '=', model)]], {'limit': 1})[0]
+        return self._model_ids[model]
+
+    def install_modules(self, domain):
+        domain = [('state', '=', 'uninstalled')] + domain
+        module_ids = self.execute_kw('ir.module.module', 'search', [domain])
+        if module_ids:
+            self.execute_kw('ir.module.module', 'button_immediate_install', [module_ids])
+
+    def code_eval(self, code, name='RPC Code Eval'):
+        vals = {
+            'name': name,
+            'state': 'code',
+            'code': code,
+            # it's not really important which model to use
+            'model_id': self.model_id('res.users'),
+        }
+        action_ids = self.execute_kw('ir.actions.server', 'create', [vals])
+        self.execute_kw('ir.actions.server', 'run', [action_ids])
+        # don't leave the action in the database
+        self.execute_kw('ir.actions.server', 'unlink', [action_ids])
+
+
+def rpc_forget(url, db_name):
+    """Drop cached authentication, e.g. when database is dropped"""
+    for key in [k for k in _uid_cache if k[:2] == (url, db_name)]:
+        _uid_cache.pop(key, None)
+
+
+def rpc_db(url, master_password, method, *args):
+    """Call a method of database service, e.g. create_database, duplicate_database, drop"""
+    _logger.debug('RPC DB: %s(*%s)', method, args)
+    proxy = server_proxy('{}/xmlrpc/2/db'.format(url))
+    return getattr(proxy, method)(master_password, *args)
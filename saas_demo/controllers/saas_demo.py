@@ -1,12 +1,14 @@
 # Copyright 2018 Ivan Yelizariev <https://it-projects.info/team/yelizariev>
 # Copyright 2019 Denis Mudarisov <https://it-projects.info/team/trojikman>
 # License AGPL-3.0 or later (https://www.gnu.org/licenses/agpl.html).
+from odoo.addons.saas import metrics
 from odoo.addons.saas_public.controllers.saas_public import SaaSPublicController
 from odoo.http import route, request
 
 
 class SaasDemoController(SaaSPublicController):
     @route('/demo/<string:vendor>/<string:repo>/<string:branch>/<string:module>', type='http', auth='public')
+    @metrics.timed('saas_public_request', route='create_demo_build')
     def create_demo_build(self, vendor, repo, branch, module, **kwargs):
         if not kwargs:
             kwargs = {}
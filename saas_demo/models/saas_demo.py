@@ -9,7 +9,7 @@ from urllib.parse import urlparse
 from odoo import models, fields, api
 
 from odoo.addons.queue_job.job import job
-from ..os import analysis_dir, update_repo, get_manifests
+from ..os import analysis_dir, update_repos, get_manifests, remote_heads
 from ..odoo import is_test
 
 _logger = logging.getLogger(__name__)
@@ -40,58 +40,107 @@ class Demo(models.Model):
             self.repos_updating_start(demos_for_immediate_update)
 
     def update_modules_templates(self, path, demo, demos_for_immediate_update, repo):
-        for module, manifest in get_manifests(path).items():
-            if not manifest.get('saas_demo_title'):
-                # not a demo
-                continue
-            if not manifest.get('installable', True):
-                # not installable
+        """Synchronize templates of the repo with demo modules in one pass:
+        existing records are fetched at once, new ones are created in batches
+        and only templates with changed values are written"""
+        manifests = {
+            module: manifest
+            # only demo modules are returned
+            for module, manifest in get_manifests(path, demo_only=True).items()
+            if manifest.get('installable', True)
+        }
+        if not manifests:
+            return demos_for_immediate_update
+
+        modules_to_show = {}
+        modules_to_install = {}
+        for module, manifest in manifests.items():
+            modules_to_show[module] = [module] + (manifest.get('saas_demo_addons') or [])
+            modules_to_install[module] = modules_to_show[module] + (manifest.get('saas_demo_addons_hidden') or [])
+        all_modules = set(manifests)
+        for names in modules_to_install.values():
+            all_modules.update(names)
+        module_ids = self._get_module_ids(all_modules)
+
+        templates = self.env['saas.template'].search([
+            ('repo_id', '=', repo.id),
+            ('demo_main_addon_id.name', 'in', list(manifests)),
+        ])
+        template_by_module = {t.demo_main_addon_id.name: t for t in templates}
+        new_modules = [m for m in manifests if m not in template_by_module]
+        if new_modules:
+            new_templates = self.env['saas.template'].create([{
+                'repo_id': repo.id,
+                'demo_main_addon_id': module_ids[module][0],
+                'template_demo': True,
+                'public_access': True,
+            } for module in new_modules])
+            template_by_module.update(zip(new_modules, new_templates))
+            line_vals = []
+            for operator in demo.operator_ids:
+                db_names = operator.generate_db_names(len(new_templates))
+                line_vals += [{
+                    'operator_db_name': db_name,
+                    'template_id': template.id,
+                    'operator_id': operator.id,
+                } for db_name, template in zip(db_names, new_templates)]
+            self.env['saas.template.operator'].create(line_vals)
+            # we don’t need the template to start building now
+            demo.operator_ids.write({'update_repos_state': 'none'})
+            demos_for_immediate_update |= demo
+
+        # group templates by the values to write, so equal updates are done at once
+        to_write = {}
+        for module, template in template_by_module.items():
+            name = manifests[module].get('saas_demo_title')
+            install_ids = self._ids_to_add(template.template_module_ids, modules_to_install[module], module_ids)
+            show_ids = self._ids_to_add(template.demo_addon_ids, modules_to_show[module], module_ids)
+            if template.name == name and not install_ids and not show_ids:
                 continue
-            template = self.env['saas.template'].search([
-                ('repo_id', '=', repo.id),
-                ('demo_main_addon_id.name', '=', module),
-            ])
-            if not template:
-                module_rec = self.env['saas.module'].search([('name', '=', module)])
-                if not module_rec:
-                    module_rec = self.env['saas.module'].create({
-                        'name': module
-                    })
-                template = self.env['saas.template'].create({
-                    'repo_id': repo.id,
-                    'demo_main_addon_id': module_rec.id,
-                    'template_demo': True,
-                    'public_access': True,
-                })
-                for operator in self.operator_ids:
-                    # we don’t need the template to start building now
-                    operator.update_repos_state = 'none'
-                    self.env['saas.template.operator'].create({
-                        'operator_db_name': operator.generate_db_name(),
-                        'template_id': template.id,
-                        'operator_id': operator.id,
-                    })
-                demos_for_immediate_update |= demo
-            modules_to_show = [module] + (manifest.get('saas_demo_addons') or [])
-            modules_to_install = modules_to_show + (manifest.get('saas_demo_addons_hidden') or [])
-            template.write({
-                'name': manifest.get('saas_demo_title'),
-                'template_module_ids': self.get_module_vals(modules_to_install),
-                'demo_addon_ids': self.get_module_vals(modules_to_show),
-            })
+            key = (name, install_ids, show_ids)
+            to_write[key] = to_write.get(key, self.env['saas.template']) | template
+        for (name, install_ids, show_ids), records in to_write.items():
+            vals = {'name': name}
+            # writing template_module_ids marks the templates to rebuild, even if nothing is added
+            if install_ids:
+                vals['template_module_ids'] = [(4, module_id, 0) for module_id in install_ids]
+            if show_ids:
+                vals['demo_addon_ids'] = [(4, module_id, 0) for module_id in show_ids]
+            records.write(vals)
+
+        written = sum(len(records) for records in to_write.values())
+        _logger.info(
+            'Templates of %s (%s): %s created, %s updated, %s unchanged',
+            repo.url, repo.branch, len(new_modules), written - len(new_modules), len(template_by_module) - written)
         return demos_for_immediate_update
 
+    @api.model
+    def _get_module_ids(self, names):
+        """
+        :return: dict name -> list of saas.module ids. Missing modules are created
+        """
+        module_ids = {}
+        for module in self.env['saas.module'].search_read([('name', 'in', list(names))], ['name']):
+            module_ids.setdefault(module['name'], []).append(module['id'])
+        missing = sorted(set(names) - set(module_ids))
+        if missing:
+            created = self.env['saas.module'].create([{'name': name} for name in missing])
+            for name, module in zip(missing, created):
+                module_ids[name] = [module.id]
+        return module_ids
+
+    @api.model
+    def _ids_to_add(self, current, names, module_ids):
+        """
+        :return: sorted tuple of ids to be linked to the template in addition to ``current`` records
+        """
+        ids = {module_id for name in names for module_id in module_ids[name]}
+        return tuple(sorted(ids - set(current.ids)))
+
     @api.model
     def get_module_vals(self, modules):
-        module_ids = self.env['saas.module'].search([('name', 'in', modules)])
-        existing_modules = module_ids.mapped('name')
-        for module in modules:
-            if module not in existing_modules:
-                new_module = self.env['saas.module'].create({'name': module})
-                module_ids |= new_module
-                existing_modules.append(module)
-        vals = [(4, module.id, 0) for module in module_ids]
-        return vals
+        module_ids = self._get_module_ids(modules)
+        return [(4, module_id, 0) for ids in module_ids.values() for module_id in ids]
 
     @api.model
     @job
@@ -168,6 +217,7 @@ class Repo(models.Model):
     branch = fields.Char('Branch', required=True)
     demo_repo = fields.Boolean('Scan for demo', default=True)
     commit = fields.Char('Commit SHA', help='Last processed point')
+    fetch_error = fields.Char('Fetch Error', readonly=True, help='Error of the last repository update')
 
     @api.depends('url')
     def _compute_url_dependent_fields(self):
@@ -187,12 +237,26 @@ class Repo(models.Model):
                 repo = repo[:-4]
             r.repo_name = repo
 
+    def _get_remote_heads(self):
+        """
+        :return: dict repo -> last commit of the branch (or None if it's unknown)
+        """
+        heads = remote_heads([(r.url, r.branch) for r in self])
+        return {r: heads[(r.url, r.branch)] for r in self}
+
     def _local_update_repo(self, update_commit=True):
         analysis_root = analysis_dir()
         updated = False
+        heads = self._get_remote_heads()
+        paths = {repo: os.path.join(analysis_root, repo.branch, repo.url_escaped) for repo in self}
+        # repositories without new commits are not fetched
+        results = update_repos([(paths[repo], repo.url, repo.branch, heads[repo]) for repo in self])
         for repo in self:
-            analysis_path = os.path.join(analysis_root, repo.branch, repo.url_escaped)
-            commit = update_repo(analysis_path, repo.url, repo.branch)
+            commit, error = results[paths[repo]]
+            if repo.fetch_error != error:
+                repo.fetch_error = error
+            if error:
+                continue
             if commit != repo.commit:
                 updated = True
                 if update_commit:
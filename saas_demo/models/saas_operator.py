@@ -5,7 +5,7 @@ import logging
 import os.path
 
 from odoo import models, fields, api, service
-from ..os import repos_dir, update_addons_path, root_odoo_path, git, update_repo
+from ..os import repos_dir, update_addons_path, root_odoo_path, git, update_repos
 from ..odoo import is_test
 
 _logger = logging.getLogger(__name__)
@@ -53,6 +53,7 @@ class SAASOperator(models.Model):
             .filtered(lambda r: r.state != 'draft')\
             .write({
                 'to_rebuild': True,
+                'full_rebuild': True,
             })
 
         # update odoo source only when we have updates in other repositories.
@@ -103,29 +104,22 @@ class SAASOperator(models.Model):
         self.ensure_one()
         if self.type != 'local':
             return
+        repos = self.demo_id.repo_ids
+        heads = repos._get_remote_heads()
+        repos_root = repos_dir()
+        paths = {repo: os.path.join(repos_root, repo.branch, repo.url_escaped) for repo in repos}
+        # new checkouts are updates too, but only once they are really checked out
+        missing = {repo for repo in repos if not os.path.isdir(paths[repo])}
+        # all repositories are fetched at the same time, the ones without new commits are skipped
+        results = update_repos([(paths[repo], repo.url, repo.branch, heads[repo]) for repo in repos])
         has_updates = False
-        for repo in self.demo_id.repo_ids:
-            updated = self._local_server_update_repo(repo.url, repo.url_escaped, repo.branch, repo.commit)
-            if updated:
+        for repo in repos:
+            commit, error = results[paths[repo]]
+            if repo.fetch_error != error:
+                repo.fetch_error = error
+            if error:
+                _logger.error('Repository %s (%s) is not updated: %s', repo.url, repo.branch, error)
+                continue
+            if repo in missing or commit != repo.commit:
                 has_updates = True
         return has_updates
-
-    @staticmethod
-    def _local_server_update_repo(url, url_escaped, branch, commit):
-        """
-        Updates git repository
-        :param url: link to git repository
-        :param url_escaped: used for directory name
-        :param branch: repository branch to be cloned
-        :param commit: commit hash
-        :return bool: whether the repository was updated or not
-        """
-        repos_root = repos_dir()
-        updated = False
-        repos_path = os.path.join(repos_root, branch, url_escaped)
-        if not os.path.isdir(os.path.join(repos_path)):
-            updated = True
-        current_commit = update_repo(repos_path, url, branch)
-        if current_commit != commit:
-            updated = True
-        return updated
@@ -3,11 +3,17 @@
 # License AGPL-3.0 or later (https://www.gnu.org/licenses/agpl.html).
 # Some code is based on https://github.com/odoo/odoo-extra/blob/master/runbot/runbot.py
 import subprocess
+from concurrent.futures import ThreadPoolExecutor
 import os
 import os.path
 import logging
 import errno
+import fcntl
 import io
+import json
+import re
+import shutil
+from contextlib import contextmanager
 from os.path import join as opj
 import ast
 try:
@@ -23,6 +29,11 @@ import odoo
 _logger = logging.getLogger(__name__)
 config_parser = ConfigParser.ConfigParser()
 
+# max number of repositories fetched at the same time
+REPO_CONCURRENCY = 8
+# seconds to wait for a git command
+GIT_TIMEOUT = 600
+
 
 # SYSTEM
 def run(l, env=None):
@@ -56,19 +67,158 @@ def mkdir(d):
 
 
 # GIT
-def git(path, cmd):
+def git(path, cmd, timeout=None):
     cmd = ['git', '-C', path] + cmd
     _logger.debug("git: %s", ' '.join(cmd))
-    return subprocess.check_output(cmd).strip().decode('utf-8')
+    return subprocess.check_output(cmd, timeout=timeout).strip().decode('utf-8')
+
+
+def remote_heads(repos):
+    """Get last commits of branches without fetching. One request per repository url
+
+    :param repos: list of (url, branch)
+    :return: dict (url, branch) -> commit. Commit is None when it's unknown, e.g. server is not available
+    """
+    branches_by_url = {}
+    for url, branch in repos:
+        branches_by_url.setdefault(url, set()).add(branch)
+
+    def ls_remote(url):
+        heads = {}
+        cmd = ['git', 'ls-remote', '--heads', url] + ['refs/heads/%s' % b for b in sorted(branches_by_url[url])]
+        _logger.debug("git: %s", ' '.join(cmd))
+        try:
+            output = subprocess.check_output(cmd, timeout=GIT_TIMEOUT).decode('utf-8')
+        except (subprocess.SubprocessError, OSError):
+            _logger.warning('Cannot get heads of %s', url, exc_info=True)
+            output = ''
+        for line in output.splitlines():
+            commit, ref = line.split('\t', 1)
+            heads[ref[len('refs/heads/'):]] = commit
+        return heads
+
+    res = {}
+    with ThreadPoolExecutor(max_workers=REPO_CONCURRENCY) as pool:
+        for url, heads in zip(branches_by_url, pool.map(ls_remote, branches_by_url)):
+            for branch in branches_by_url[url]:
+                res[(url, branch)] = heads.get(branch)
+    return res
+
+
+def local_head(path):
+    """Commit of the checkout or None if there is no checkout"""
+    if not os.path.exists(os.path.join(path, '.git')):
+        return None
+    try:
+        return git(path, ['rev-parse', 'HEAD'])
+    except subprocess.CalledProcessError:
+        return None
+
+
+def update_repos(tasks, concurrency=REPO_CONCURRENCY, timeout=GIT_TIMEOUT):
+    """Update several checkouts at the same time (see update_repo)
+
+    :param tasks: list of (path, repo_url, branch, remote_commit)
+    :param timeout: seconds to wait for each git command
+    :return: dict path -> (commit, error). Commit is None if the update is failed
+    """
+    def update(task):
+        path, repo_url, branch, remote_commit = task
+        try:
+            return update_repo(path, repo_url, branch, remote_commit, timeout=timeout), None
+        except Exception as e:
+            _logger.warning('Cannot update %s (%s) in %s', repo_url, branch, path, exc_info=True)
+            return None, str(e) or e.__class__.__name__
+
+    if not tasks:
+        return {}
+    with ThreadPoolExecutor(max_workers=min(concurrency, len(tasks))) as pool:
+        return dict(zip([t[0] for t in tasks], pool.map(update, tasks)))
+
+
+def update_repo(path, repo_url, branch, remote_commit=None, timeout=None):
+    """Checkout the branch to the path. Objects are stored once per url in a bare mirror,
+    the path is a worktree of the mirror
+
+    :param remote_commit: last commit of the branch (see remote_heads). Nothing is fetched,
+                          if the checkout is already on that commit
+    :param timeout: seconds to wait for each git command
+    :return: commit
+    """
+    if remote_commit and local_head(path) == remote_commit:
+        return remote_commit
+    mirror = mirror_path(repo_url)
+    with mirror_lock(mirror):
+        update_mirror(mirror, repo_url, branch, timeout)
+        add_worktree(mirror, path, branch, timeout)
+    return git(path, ['rev-parse', 'HEAD'])
+
+
+def mirrors_dir():
+    d = os.path.join(tools.config['data_dir'], 'mirrors')
+    return mkdir(d)
+
+
+def mirror_path(repo_url):
+    return os.path.join(mirrors_dir(), re.sub(r'[^\w.-]', '_', repo_url))
+
+
+@contextmanager
+def mirror_lock(mirror):
+    """Mirror is shared by all processes of the server"""
+    with open(mirror + '.lock', 'w') as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
 
 
-def update_repo(path, repo_url, branch):
-    if not os.path.isdir(os.path.join(path)):
-        run(['git', 'clone', repo_url, path])
-    git(path, ['fetch', 'origin'])
-    git(path, ['checkout', 'origin/%s' % branch])
-    commit = git(path, ['rev-parse', 'origin/%s' % branch])
-    return commit
+def update_mirror(mirror, repo_url, branch, timeout=None):
+    """Fetch the branch to refs/remotes/origin/<branch> of the bare mirror.
+    File contents are downloaded only for checked out commits, when server supports partial clone"""
+    if not os.path.isdir(mirror):
+        cmd = ['git', 'clone', '--bare', '--filter=blob:none', '--no-tags', repo_url, mirror]
+        _logger.debug("git: %s", ' '.join(cmd))
+        subprocess.check_call(cmd, timeout=timeout)
+    git(mirror, ['fetch', '--no-tags', 'origin', '+refs/heads/%s:refs/remotes/origin/%s' % (branch, branch)],
+        timeout=timeout)
+
+
+def is_worktree_valid(path):
+    """Whether the worktree may be used. It's not the case, when its gitdir is deleted,
+    e.g. the mirror is deleted or data_dir is moved"""
+    try:
+        with open(os.path.join(path, '.git')) as f:
+            gitdir = f.read().strip()
+    except OSError:
+        return False
+    if not gitdir.startswith('gitdir:'):
+        return False
+    gitdir = os.path.join(path, gitdir[len('gitdir:'):].strip())
+    if not os.path.isdir(gitdir):
+        return False
+    try:
+        git(path, ['rev-parse', '--git-dir'])
+    except subprocess.CalledProcessError:
+        return False
+    return True
+
+
+def add_worktree(mirror, path, branch, timeout=None):
+    if os.path.isdir(os.path.join(path, '.git')):
+        # full clone made by previous versions of the module
+        shutil.rmtree(path)
+    elif os.path.exists(path) and not is_worktree_valid(path):
+        _logger.info('Worktree %s is broken and will be created again', path)
+        shutil.rmtree(path)
+    if os.path.exists(os.path.join(path, '.git')):
+        git(path, ['checkout', '--detach', '--force', 'origin/%s' % branch], timeout=timeout)
+        return
+    # forget worktrees which directories are deleted
+    git(mirror, ['worktree', 'prune'])
+    mkdir(os.path.dirname(path))
+    git(mirror, ['worktree', 'add', '--detach', '--force', path, 'origin/%s' % branch], timeout=timeout)
 
 
 def analysis_dir():
@@ -142,10 +292,38 @@ def file_open(name, mode="r", pathinfo=False):
         return _fileopen(name, mode=mode, basedir=base, pathinfo=pathinfo)
 
 
-def load_information_from_description_file(module, mod_path):
+class Manifest(dict):
+    """Manifest, which reads README only when description is requested"""
+
+    def __init__(self, info, mod_path):
+        super(Manifest, self).__init__(info)
+        self.mod_path = mod_path
+
+    def _load_description(self):
+        if not dict.get(self, 'description') and not getattr(self, '_readme_loaded', False):
+            self._readme_loaded = True
+            readme_path = [opj(self.mod_path, x) for x in README
+                           if os.path.isfile(opj(self.mod_path, x))]
+            if readme_path:
+                with file_open(readme_path[0]) as f:
+                    self['description'] = f.read()
+
+    def __getitem__(self, key):
+        if key == 'description':
+            self._load_description()
+        return super(Manifest, self).__getitem__(key)
+
+    def get(self, key, default=None):
+        if key == 'description':
+            self._load_description()
+        return super(Manifest, self).get(key, default)
+
+
+def load_information_from_description_file(module, mod_path, readme=True):
     """
     :param module: The name of the module (sale, purchase, ...)
     :param mod_path: Physical path of module, if not providedThe name of the module (sale, purchase, ...)
+    :param readme: whether to read README, when description is empty
     """
     manifest_file = module_manifest(mod_path)
     if manifest_file:
@@ -175,7 +353,7 @@ def load_information_from_description_file(module, mod_path):
         finally:
             f.close()
 
-        if not info.get('description'):
+        if readme and not info.get('description'):
             readme_path = [opj(mod_path, x) for x in README
                            if os.path.isfile(opj(mod_path, x))]
             if readme_path:
@@ -193,21 +371,76 @@ def load_information_from_description_file(module, mod_path):
     return {}
 
 
-def get_manifests(path):
+def manifests_cache_dir():
+    d = os.path.join(tools.config['data_dir'], 'manifests')
+    return mkdir(d)
 
-    def is_really_module(name):
-        for mname in MANIFEST_NAMES:
-            if os.path.isfile(os.path.join(path, name, mname)):
-                return True
 
-    modules = [
-        it
-        for it in os.listdir(path)
-        if is_really_module(it)
-    ]
-    res = {}
-    for mname in modules:
-        mod_path = os.path.join(path, mname)
-        info = load_information_from_description_file(mname, mod_path)
-        res[mname] = info
-    return res
+def _is_really_module(path, name):
+    for mname in MANIFEST_NAMES:
+        if os.path.isfile(os.path.join(path, name, mname)):
+            return True
+
+
+def _scan_manifests(path, modules):
+    """
+    :return: dict module -> manifest without README
+    """
+    return {
+        mname: load_information_from_description_file(mname, os.path.join(path, mname), readme=False)
+        for mname in modules
+        if _is_really_module(path, mname)
+    }
+
+
+def _changed_modules(path, old_commit, new_commit):
+    """
+    :return: set of top level folders changed between the commits or None if it's unknown
+    """
+    try:
+        output = git(path, ['diff', '--name-only', old_commit, new_commit])
+    except subprocess.CalledProcessError:
+        return None
+    return {name.split('/', 1)[0] for name in output.splitlines() if '/' in name}
+
+
+def get_manifests(path, demo_only=False):
+    """Manifests of modules in the folder. For git checkouts they are cached per commit,
+    and only modules changed since the cached commit are parsed again
+
+    :param demo_only: return only manifests with saas_demo_title
+    :return: dict module -> manifest. README is read on first access to description
+    """
+    commit = local_head(path)
+    cache_file = os.path.join(manifests_cache_dir(), re.sub(r'[^\w.-]', '_', os.path.abspath(path)) + '.json')
+    cache = {}
+    if commit and os.path.isfile(cache_file):
+        try:
+            with open(cache_file) as f:
+                cache = json.load(f)
+        except ValueError:
+            cache = {}
+
+    changed = None
+    if cache.get('commit') == commit:
+        changed = set()
+    elif cache.get('commit') and commit:
+        changed = _changed_modules(path, cache['commit'], commit)
+
+    if changed is None:
+        manifests = _scan_manifests(path, os.listdir(path))
+    else:
+        manifests = {m: info for m, info in cache.get('manifests', {}).items() if m not in changed}
+        manifests.update(_scan_manifests(path, changed))
+
+    if commit and cache.get('commit') != commit:
+        tmp_file = '%s.%s.tmp' % (cache_file, os.getpid())
+        with open(tmp_file, 'w') as f:
+            json.dump({'commit': commit, 'manifests': manifests}, f, default=list)
+        os.rename(tmp_file, cache_file)
+
+    return {
+        mname: Manifest(info, os.path.join(path, mname))
+        for mname, info in manifests.items()
+        if not demo_only or info.get('saas_demo_title')
+    }
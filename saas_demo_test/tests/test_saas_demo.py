@@ -1,9 +1,13 @@
 # Copyright 2019 Denis Mudarisov <https://it-projects.info/team/trojikman>
 # License AGPL-3.0 or later (https://www.gnu.org/licenses/agpl.html).
+import os.path
 import shutil
+import subprocess
+import tempfile
 
 from odoo.tests.common import HttpCase, tagged
-from odoo.addons.saas_demo.os import analysis_dir, repos_dir
+from odoo.addons.saas_demo.os import analysis_dir, repos_dir, mirrors_dir, mirror_path, remote_heads, \
+    get_manifests, manifests_cache_dir
 
 
 @tagged('post_install', 'at_install')
@@ -33,8 +37,142 @@ class TestSaasDemo(HttpCase):
 
     def test_saas_demo(self):
         self.saas_demo.fetch_and_generate_templates()
+        # checkouts share objects of the mirror
+        self.assertTrue(os.path.isdir(mirror_path(self.saas_demo_repo.url)))
+        checkout = os.path.join(analysis_dir(), self.saas_demo_repo.branch, self.saas_demo_repo.url_escaped)
+        self.assertTrue(os.path.isfile(os.path.join(checkout, '.git')))
+        # templates are not duplicated on the next synchronization
+        templates = self.env['saas.template'].search([('repo_id', '=', self.saas_demo_repo.id)])
+        self.assertTrue(templates)
+        self.assertEqual(len(templates.mapped('operator_ids')), len(templates))
+        self.saas_demo.update_modules_templates(checkout, self.saas_demo, self.saas_demo.browse(), self.saas_demo_repo)
+        self.assertEqual(self.env['saas.template'].search([('repo_id', '=', self.saas_demo_repo.id)]), templates)
+
+    def test_rename_template(self):
+        path = tempfile.mkdtemp()
+
+        def write_module(title):
+            os.makedirs(os.path.join(path, 'demo_module'), exist_ok=True)
+            with open(os.path.join(path, 'demo_module', '__manifest__.py'), 'w') as f:
+                f.write(repr({'name': 'Demo', 'saas_demo_title': title}))
+            subprocess.check_call(['git', '-C', path, 'add', '-A'])
+            subprocess.check_call(['git', '-C', path, '-c', 'user.name=test', '-c', 'user.email=test@example.com',
+                                   'commit', '-q', '-m', title])
+
+        subprocess.check_call(['git', 'init', '-q', path])
+        write_module('Demo')
+        self.saas_demo.update_modules_templates(path, self.saas_demo, self.saas_demo.browse(), self.saas_demo_repo)
+        template = self.env['saas.template'].search([('repo_id', '=', self.saas_demo_repo.id)])
+        self.assertEqual(template.name, 'Demo')
+        template.operator_ids.write({'to_rebuild': False})
+
+        # new title doesn't require to rebuild the template
+        write_module('Renamed Demo')
+        self.saas_demo.update_modules_templates(path, self.saas_demo, self.saas_demo.browse(), self.saas_demo_repo)
+        self.assertEqual(template.name, 'Renamed Demo')
+        self.assertTrue(template.operator_ids)
+        self.assertFalse(any(template.operator_ids.mapped('to_rebuild')))
+        shutil.rmtree(path)
+
+    def init_origin(self):
+        """Local bare repository, which stands in for the remote one
+
+        :return: temporary directory, url of the repository and function to push a new commit to 12.0 branch
+        """
+        tmp = tempfile.mkdtemp()
+        origin = os.path.join(tmp, 'origin.git')
+        work = os.path.join(tmp, 'work')
+
+        def commit(message):
+            subprocess.check_call(['git', '-C', work, '-c', 'user.name=test', '-c', 'user.email=test@example.com',
+                                   'commit', '-q', '--allow-empty', '-m', message])
+            subprocess.check_call(['git', '-C', work, 'push', '-q', 'origin', 'HEAD:refs/heads/12.0'])
+            return subprocess.check_output(['git', '-C', work, 'rev-parse', 'HEAD']).strip().decode()
+
+        subprocess.check_call(['git', 'init', '-q', '--bare', origin])
+        subprocess.check_call(['git', 'clone', '-q', origin, work])
+        return tmp, 'file://' + origin, commit
+
+    def test_change_detection(self):
+        tmp, origin_url, commit = self.init_origin()
+        first = commit('first')
+        repo = self.env['saas.demo.repo'].create({
+            'url': origin_url,
+            'branch': '12.0',
+        })
+        self.assertEqual(remote_heads([(repo.url, '12.0'), (repo.url, 'missing')]), {
+            (repo.url, '12.0'): first,
+            (repo.url, 'missing'): None,
+        })
+        self.assertTrue(repo._local_update_repo())
+        self.assertEqual(repo.commit, first)
+        # nothing is changed
+        self.assertFalse(repo._local_update_repo())
+        second = commit('second')
+        self.assertTrue(repo._local_update_repo())
+        self.assertEqual(repo.commit, second)
+
+        # errors are reported per repository
+        broken_repo = self.env['saas.demo.repo'].create({
+            'url': 'file://' + os.path.join(tmp, 'missing.git'),
+            'branch': '12.0',
+        })
+        self.assertFalse((repo | broken_repo)._local_update_repo())
+        self.assertFalse(repo.fetch_error)
+        self.assertTrue(broken_repo.fetch_error)
+        shutil.rmtree(tmp)
+
+    def test_deleted_mirror(self):
+        tmp, origin_url, commit = self.init_origin()
+        commit('first')
+        repo = self.env['saas.demo.repo'].create({
+            'url': origin_url,
+            'branch': '12.0',
+        })
+        self.assertTrue(repo._local_update_repo())
+        # checkouts refer to the deleted mirror, so they are created again
+        shutil.rmtree(mirrors_dir())
+        second = commit('second')
+        self.assertTrue(repo._local_update_repo())
+        self.assertEqual(repo.commit, second)
+        self.assertFalse(repo.fetch_error)
+        shutil.rmtree(tmp)
+
+    def test_manifests_cache(self):
+        path = tempfile.mkdtemp()
+
+        def write_module(name, manifest):
+            os.makedirs(os.path.join(path, name), exist_ok=True)
+            with open(os.path.join(path, name, '__manifest__.py'), 'w') as f:
+                f.write(repr(manifest))
+            with open(os.path.join(path, name, 'README.rst'), 'w') as f:
+                f.write('Readme of %s' % name)
+
+        def commit():
+            subprocess.check_call(['git', '-C', path, 'add', '-A'])
+            subprocess.check_call(['git', '-C', path, '-c', 'user.name=test', '-c', 'user.email=test@example.com',
+                                   'commit', '-q', '-m', 'update'])
+
+        subprocess.check_call(['git', 'init', '-q', path])
+        write_module('demo_module', {'name': 'Demo', 'saas_demo_title': 'Demo'})
+        write_module('other_module', {'name': 'Other'})
+        commit()
+        manifests = get_manifests(path)
+        self.assertEqual(set(manifests), {'demo_module', 'other_module'})
+        self.assertEqual(manifests['demo_module']['description'], 'Readme of demo_module')
+        self.assertEqual(set(get_manifests(path, demo_only=True)), {'demo_module'})
+
+        write_module('other_module', {'name': 'Other', 'saas_demo_title': 'Other'})
+        shutil.rmtree(os.path.join(path, 'demo_module'))
+        commit()
+        manifests = get_manifests(path, demo_only=True)
+        self.assertEqual(set(manifests), {'other_module'})
+        self.assertEqual(manifests['other_module']['saas_demo_title'], 'Other')
+        shutil.rmtree(path)
 
     def tearDown(self):
         super(TestSaasDemo, self).tearDown()
         shutil.rmtree(analysis_dir())
         shutil.rmtree(repos_dir())
+        shutil.rmtree(mirrors_dir())
+        shutil.rmtree(manifests_cache_dir())
@@ -5,7 +5,7 @@
     "summary": """Module for creating public builds""",
     "category": "SaaS",
     "images": [],
-    "version": "12.0.1.0.0",
+    "version": "12.0.1.5.1",
     "application": False,
 
     "author": "IT-Projects LLC, Denis Mudarisov",
@@ -21,6 +21,7 @@
     "external_dependencies": {"python": [], "bin": []},
     "data": [
         "views/saas_template_operator_views.xml",
+        "views/saas_public_templates.xml",
     ],
     "demo": [
         "demo/public_saas_template_demo.xml",
@@ -1,23 +1,83 @@
 # Copyright 2019 Denis Mudarisov <https://it-projects.info/team/trojikman>
 # License AGPL-3.0 or later (https://www.gnu.org/licenses/agpl.html).
+import json
 
 from odoo.http import route, request, Controller
+from odoo.addons.saas import metrics
+
+SESSION_BUILDS_KEY = 'saas_public_build_ids'
+# only a few last builds of the visitor are kept in the session
+SESSION_BUILDS_LIMIT = 10
+# states of the build, which is still being created
+PREPARING_STATES = ['duplicating', 'post_init']
 
 
 class SaaSPublicController(Controller):
     @route('/saas_public/<int:template_id>/create-fast-build', type='http', auth='public')
+    @metrics.timed('saas_public_request', route='create_fast_build')
     def create_fast_build(self, template_id, **kwargs):
         if not kwargs:
             kwargs = {}
         template = request.env['saas.template'].browse(template_id).sudo()
         return self._redirect_to_build(template, kwargs)
 
+    @route('/saas_public/build/<int:build_id>/status', type='http', auth='public')
+    @metrics.timed('saas_public_request', route='build_status')
+    def build_status(self, build_id, **kwargs):
+        build = self._get_session_build(build_id)
+        if not build:
+            return request.not_found()
+        values = {'state': build.state}
+        if build.state == 'done':
+            values['url'] = '/saas_public/build/%s/login' % build.id
+        elif build.state not in PREPARING_STATES:
+            # the build is failed or dropped, so it will never be ready
+            values['error'] = 'Build cannot be created. Please try again later.'
+        return request.make_response(json.dumps(values), headers=[
+            ('Content-Type', 'application/json'),
+            ('Cache-Control', 'no-store'),
+        ])
+
+    @route('/saas_public/build/<int:build_id>/login', type='http', auth='public')
+    @metrics.timed('saas_public_request', route='build_login')
+    def build_login(self, build_id, **kwargs):
+        build = self._get_session_build(build_id)
+        if not build or build.state != 'done':
+            return request.not_found()
+        return self._auth_to_build(build)
+
     def _redirect_to_build(self, template, kwargs):
         if template and template.public_access:
-            template_operator_id = template.operator_ids.random_ready_operator()
-            build = template_operator_id.create_db(kwargs, with_delay=False)
-            build_url = build.get_url()
-            return request.env['auth_quick_master.token'].sudo().redirect_with_token(build_url, build.id,
-                                                                                     build_login='admin')
+            template_operator_id = template.operator_ids.select_ready_operator()
+            if not template_operator_id:
+                return request.not_found()
+            build = template_operator_id.claim_spare_build(kwargs)
+            if not build:
+                if template.public_async_build:
+                    build = template_operator_id.create_db(kwargs)
+                    return self._build_waiting_page(build)
+                build = template_operator_id.create_db(kwargs, with_delay=False)
+                if build.state == 'failed':
+                    # the page shows the error
+                    return self._build_waiting_page(build)
+            return self._auth_to_build(build)
         else:
             return request.not_found()
+
+    def _auth_to_build(self, build):
+        build_url = build.get_url()
+        return request.env['auth_quick_master.token'].sudo().redirect_with_token(build_url, build.id,
+                                                                                 build_login='admin')
+
+    def _build_waiting_page(self, build):
+        # only the visitor who requested the build may follow its progress
+        build_ids = request.session.get(SESSION_BUILDS_KEY, []) + [build.id]
+        request.session[SESSION_BUILDS_KEY] = build_ids[-SESSION_BUILDS_LIMIT:]
+        return request.render('saas_public.build_waiting', {
+            'status_url': '/saas_public/build/%s/status' % build.id,
+        })
+
+    def _get_session_build(self, build_id):
+        if build_id not in request.session.get(SESSION_BUILDS_KEY, []):
+            return None
+        return request.env['saas.db'].sudo().browse(build_id).exists()
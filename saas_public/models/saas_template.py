@@ -8,3 +8,15 @@ class SAASTemplate(models.Model):
     _inherit = 'saas.template'
 
     public_access = fields.Boolean(default=False)
+    public_async_build = fields.Boolean(
+        'Non-blocking build creation', default=False,
+        help='Public builds are created in background while the visitor waits on a progress page')
+
+
+class SAASTemplateOperator(models.Model):
+    _inherit = 'saas.template.operator'
+
+    def _rebuild_sort_key(self):
+        # templates with public traffic go first
+        key = super(SAASTemplateOperator, self)._rebuild_sort_key()
+        return (not self.template_id.public_access,) + key
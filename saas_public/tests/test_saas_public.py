@@ -40,3 +40,31 @@ class TestSaasPublic(HttpCase, Common):
         url_2 = '/saas_public/{}/create-fast-build'.format(self.private_template.id)
         private_template = self.url_open(url_2)
         self.assertIn(private_template.status_code, [404, 403], 'User should not have access to a private template')
+
+    def test_saas_public_async(self):
+        self.env['saas.template.operator'].preparing_template_next()
+        self.public_template.write({
+            'public_async_build': True,
+        })
+        url = '/saas_public/{}/create-fast-build'.format(self.public_template.id)
+        response = self.url_open(url)
+        self.assertEqual(response.status_code, 200)
+        build = self.env['saas.db'].search([('template_operator_id.template_id', '=', self.public_template.id)])
+        self.assertEqual(len(build), 1)
+        status_url = '/saas_public/build/{}/status'.format(build.id)
+        self.assertIn(status_url, response.text)
+
+        status = self.url_open(status_url).json()
+        self.assertEqual(status['state'], build.state)
+        self.assertNotIn('error', status)
+
+        # page stops waiting, when the build is failed
+        build.state = 'failed'
+        status = self.url_open(status_url).json()
+        self.assertEqual(status['state'], 'failed')
+        self.assertTrue(status['error'])
+        self.assertNotIn('url', status)
+
+        # status is available only in the session where the build was requested
+        self.opener.cookies.clear()
+        self.assertEqual(self.url_open(status_url).status_code, 404)